@@ -0,0 +1,324 @@
+"""
+Benchmarks of the auth, webhook, trigger and encryption paths.
+
+Triggers are sent to a local fake of the Pusher HTTP API. Startup
+benchmarks run a new interpreter per iteration, so they run one iteration
+for every 50 of the others. Each benchmark prints a JSON line with its
+ops/sec and p50/p99 latencies::
+
+    python benchmarks.py --iterations 1000 --latency 0.005
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from flask import Flask
+try:
+    from pusher.crypto import encrypt
+except ImportError:  # pusher<2.1 has no encrypted channels
+    encrypt = None
+
+from flask_pusher import Pusher, _ChannelKeys
+
+SOCKET_ID = "1234.5678"
+MASTER_KEY = "0123456789abcdef0123456789abcdef"
+
+pusher_conf = {
+    "PUSHER_APP_ID": "1234",
+    "PUSHER_KEY": "KEY",
+    "PUSHER_SECRET": "SUPERSECRET",
+}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakePusherAPI(object):
+    """
+    In-process fake of the Pusher HTTP API, answering every request after
+    `latency` seconds with `status`.
+    """
+    def __init__(self, latency=0, status=200):
+        self.latency = latency
+        self.status = status
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def config(self):
+        """Flask configuration sending requests to this fake."""
+        return {"PUSHER_HOST": "127.0.0.1", "PUSHER_PORT": self.port,
+                "PUSHER_SSL": False}
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self._respond(b"")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self._respond(self.rfile.read(length))
+
+            def _respond(self, body):
+                with fake._lock:
+                    fake.requests.append((self.command, self.path, body))
+                if fake.latency:
+                    time.sleep(fake.latency)
+                payload = b"{}" if fake.status == 200 else b"error"
+                self.send_response(fake.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _percentile(timings, percent):
+    index = int(round(percent / 100.0 * (len(timings) - 1)))
+    return timings[index]
+
+
+def bench(name, func, iterations, warmup=10):
+    """Run `func` `iterations` times and return its stats."""
+    for _ in range(min(warmup, iterations)):
+        func()
+    timings = []
+    start = time.time()
+    for _ in range(iterations):
+        t = time.time()
+        func()
+        timings.append(time.time() - t)
+    elapsed = time.time() - start
+    timings.sort()
+    return {
+        "name": name,
+        "iterations": iterations,
+        "ops_per_sec": iterations / elapsed if elapsed else None,
+        "p50_ms": _percentile(timings, 50) * 1000,
+        "p99_ms": _percentile(timings, 99) * 1000,
+    }
+
+
+def _make_app(**config):
+    app = Flask(__name__)
+    app.config.update(pusher_conf)
+    app.config.update(config)
+    pusher = Pusher(app)
+    pusher.auth(lambda channel_name, socket_id: True)
+    pusher.channel_data(lambda channel_name, socket_id: {
+        "user_info": {"name": "Foo", "roles": ["admin", "user"]}})
+    return app, pusher
+
+
+def auth_benchmarks():
+    app, pusher = _make_app()
+    client = app.test_client()
+
+    def auth(data):
+        def run():
+            response = client.post("/pusher/auth", data=data)
+            assert response.status_code == 200, response.status_code
+        return run
+
+    yield "auth_private", auth({
+        "channel_name": "private-a", "socket_id": SOCKET_ID,
+    })
+    yield "auth_presence", auth({
+        "channel_name": "presence-a", "socket_id": SOCKET_ID,
+    })
+    for n in (1, 10, 100):
+        data = dict(("channel_name[%d]" % i, "private-%d" % i)
+                    for i in range(n))
+        data["socket_id"] = SOCKET_ID
+        yield "auth_buffered_%d" % n, auth(data)
+
+
+def webhook_benchmarks():
+    app, pusher = _make_app()
+    pusher.webhooks.on("client_event")(lambda event: None)
+    client = app.test_client()
+
+    for size in (1024, 10240, 102400):
+        event = {"name": "client_event", "channel": "private-a",
+                 "event": "client-x", "data": ""}
+        event["data"] = "x" * (size - len(json.dumps(event)))
+        body = json.dumps({"time_ms": int(time.time() * 1000),
+                           "events": [event]})
+        with app.app_context():
+            headers = {"X-Pusher-Key": "KEY",
+                       "X-Pusher-Signature": pusher._sign(body)}
+
+        def run(body=body, headers=headers):
+            response = client.post("/pusher/events", data=body,
+                                   headers=headers)
+            assert response.status_code == 200, response.status_code
+        yield "webhook_%dk" % (size // 1024), run
+
+
+def trigger_benchmarks(latency):
+    with FakePusherAPI(latency) as api:
+        app, pusher = _make_app(**api.config)
+        with app.app_context():
+            client = pusher.client
+        data = {"message": "x" * 100}
+        yield "trigger", lambda: client.trigger("a", "ev", data)
+        batch = [{"channel": "c%d" % i, "name": "ev", "data": data}
+                 for i in range(10)]
+        yield "trigger_batch_10", lambda: client.trigger_batch(
+            [dict(e) for e in batch])
+
+
+def encryption_benchmarks(latency):
+    if encrypt is None:
+        return
+    channel = "private-encrypted-a"
+    data = {"message": "x" * 100}
+    encoded = json.dumps(data)
+    master_key = MASTER_KEY.encode("utf-8")
+    keys = _ChannelKeys()
+    # the encryption of a single event, without the HTTP request
+    yield "encrypt_event", lambda: keys.encrypt(channel, encoded, master_key)
+    yield "encrypt_event_uncached", lambda: json.dumps(
+        encrypt(channel, encoded, master_key), ensure_ascii=False)
+
+    with FakePusherAPI(latency) as api:
+        for cache_size, suffix in ((1024, ""), (0, "_uncached")):
+            app, pusher = _make_app(
+                PUSHER_ENCRYPTION_MASTER_KEY=MASTER_KEY,
+                PUSHER_CHANNEL_KEYS_CACHE_SIZE=cache_size, **api.config)
+            with app.app_context():
+                client = pusher.client
+            yield "trigger_encrypted" + suffix, lambda client=client: (
+                client.trigger(channel, "ev", data))
+
+            test_client = app.test_client()
+
+            def auth(test_client=test_client):
+                response = test_client.post("/pusher/auth", data={
+                    "channel_name": channel, "socket_id": SOCKET_ID,
+                })
+                assert response.status_code == 200, response.status_code
+            yield "auth_encrypted" + suffix, auth
+
+
+def outbox_benchmarks(latency):
+    directory = tempfile.mkdtemp()
+    try:
+        with FakePusherAPI(latency) as api:
+            app, pusher = _make_app(
+                PUSHER_OUTBOX=os.path.join(directory, "outbox.db"),
+                **api.config)
+
+            @app.route("/outbox/<int:n>")
+            def outbox(n):
+                for i in range(n):
+                    pusher.outbox("a", "ev", {"id": i})
+                return "OK"
+
+            client = app.test_client()
+            for n in (1, 10):
+                yield "outbox_request_%d" % n, lambda n=n: client.get(
+                    "/outbox/%d" % n)
+            with app.app_context():
+                pusher.client.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+STARTUP_CODE = """\
+from flask import Flask
+from flask_pusher import Pusher
+app = Flask(__name__)
+app.config.update(%r)
+Pusher(app)
+"""
+
+
+def startup_benchmarks():
+    def startup(code):
+        def run():
+            subprocess.check_call([sys.executable, "-c", code])
+        return run
+
+    yield "startup_import_flask", startup("import flask")
+    yield "startup_import", startup("import flask_pusher")
+    yield "startup_init_app", startup(STARTUP_CODE % pusher_conf)
+    yield "startup_init_app_lazy", startup(
+        STARTUP_CODE % dict(pusher_conf, PUSHER_LAZY=True))
+
+
+def run(iterations=1000, latency=0, names=None):
+    """Run the benchmarks, yielding the stats of each one."""
+    groups = [
+        (auth_benchmarks(), iterations, 10),
+        (webhook_benchmarks(), iterations, 10),
+        (trigger_benchmarks(latency), iterations, 10),
+        (encryption_benchmarks(latency), iterations, 10),
+        (outbox_benchmarks(latency), iterations, 10),
+        (startup_benchmarks(), max(1, iterations // 50), 1),
+    ]
+    for group, group_iterations, warmup in groups:
+        for name, func in group:
+            if not names or any(n in name for n in names):
+                yield bench(name, func, group_iterations, warmup)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("names", nargs="*",
+                        help="run benchmarks with these names only")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="fake Pusher API latency in seconds")
+    args = parser.parse_args(argv)
+    for result in run(args.iterations, args.latency, args.names):
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,48 @@
-from flask import Blueprint, current_app, request, abort, json
-import pusher as _pusher
-from pusher.signature import sign, verify
+import atexit
+import base64
+import collections
+import hashlib
+import hmac
+import json as _json
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import time
+import uuid
 
 try:
-    import flask_jsonpify
+    import queue
 except ImportError:  # pragma: no cover
-    from flask import jsonify
-else:
-    jsonify = flask_jsonpify.jsonify
-    flask_jsonpify__dumps = flask_jsonpify.__dumps
+    import Queue as queue
+from json import JSONEncoder
+
+from flask import (Blueprint, current_app, request, abort, g, json,
+                   copy_current_request_context, has_app_context,
+                   has_request_context)
+from flask.signals import Namespace
+from werkzeug.exceptions import HTTPException
+from werkzeug.local import LocalProxy
+
+_jsonify = None
+
+
+def jsonify(*args, **kwargs):
+    """`flask_jsonpify.jsonify`, imported on first call."""
+    global _jsonify
+    if _jsonify is None:
+        _jsonify = _load_jsonify()
+    return _jsonify(*args, **kwargs)
+
+
+def _load_jsonify():
+    try:
+        import flask_jsonpify
+    except ImportError:  # pragma: no cover
+        from flask import jsonify
+        return jsonify
 
     def __dumps(*args, **kwargs):
         indent = None
@@ -16,33 +50,1677 @@ else:
             indent = 2
 
         return json.dumps(
-            args[0] if len(args) is 1 else dict(*args, **kwargs),
+            args[0] if len(args) == 1 else dict(*args, **kwargs),
             indent=indent
         )
 
     flask_jsonpify.__dumps = __dumps
+    return flask_jsonpify.jsonify
+
+
+logger = logging.getLogger(__name__)
+
+_now = getattr(time, "monotonic", time.time)
+
+# max number of events accepted by a single `trigger_batch` call
+BATCH_LIMIT = 10
+# max number of channels accepted by a single `trigger` call
+CHANNELS_LIMIT = 100
+
+# formats accepted by the auth endpoint, checked before any auth handler
+_SOCKET_ID_RE = re.compile(r"\A\d+\.\d+\Z")
+_CHANNEL_RE = re.compile(r"\A[-a-zA-Z0-9_=@,.;]{1,200}\Z")
+_AUTH_PREFIXES = ("private-", "presence-")
+
+_missing = object()
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def data_to_string(data, json_encoder):
+    """`pusher.util.data_to_string`, without importing `pusher`."""
+    if isinstance(data, string_types):
+        return data
+    return _json.dumps(data, cls=json_encoder)
+
+
+def _channel_list(channels):
+    if isinstance(channels, (list, tuple, set, frozenset)):
+        return list(channels)
+    return [channels]
+
+
+def _with_context(func):
+    """Wrap `func` to run in another thread with the current Flask context."""
+    if has_request_context():
+        return copy_current_request_context(func)
+    if not has_app_context():
+        return func
+    app = current_app._get_current_object()
+
+    def wrapper(*args, **kwargs):
+        with app.app_context():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class _LRU(object):
+    """
+    Mapping keeping the `maxsize` most recently used entries. Not
+    thread-safe, the owners lock around their compound operations.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def get(self, key, default=None):
+        """Return the entry of `key`, now the most recently used."""
+        value = self._entries.pop(key, _missing)
+        if value is _missing:
+            return default
+        self._entries[key] = value
+        return value
+
+    def peek(self, key, default=None):
+        """Return the entry of `key` without using it."""
+        return self._entries.get(key, default)
+
+    def put(self, key, value):
+        """Set the entry of `key`, returning the evicted `(key, value)`."""
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        evicted = []
+        while len(self._entries) > self.maxsize:
+            evicted.append(self._entries.popitem(last=False))
+        return evicted
+
+    def pop(self, key, default=None):
+        return self._entries.pop(key, default)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class _Threads(object):
+    """
+    Daemon threads of a worker, started on first use in each process. A
+    forked process does not inherit the threads of its parent, so they are
+    started again in the child.
+
+    :param targets: `(function, thread name)` of each thread
+    """
+    def __init__(self, targets):
+        self.targets = list(targets)
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._pid == os.getpid()
+
+    def start(self, setup=None):
+        """Start the threads unless running, calling `setup` first."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if setup is not None:
+                setup()
+            self._threads = []
+            for target, name in self.targets:
+                thread = threading.Thread(target=target, name=name)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def stop(self):
+        """
+        Forget the threads of this process and return them, to be stopped
+        and joined by the caller. Started again by the next `start`.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return []
+            threads, self._threads = self._threads, []
+            self._pid = None
+        return threads
+
+
+_signals = Namespace()
+
+#: Sent with the duration of each request to the Pusher API.
+trigger_sent = _signals.signal("pusher-trigger-sent")
+#: Sent with the duration of the auth handlers of each auth request.
+auth_handled = _signals.signal("pusher-auth-handled")
+#: Sent with the duration of each auth request.
+auth_requested = _signals.signal("pusher-auth-requested")
+#: Sent with the duration of each webhook signature verification.
+webhook_verified = _signals.signal("pusher-webhook-verified")
+
+_metric_signals = {
+    "trigger": trigger_sent,
+    "auth_handler": auth_handled,
+    "auth": auth_requested,
+    "webhook_verify": webhook_verified,
+}
+
+
+class _Metrics(object):
+    """
+    Measure the `trigger`, `auth_handler`, `auth` and `webhook_verify`
+    metrics, sending the signals and calling the recorders.
+    Nothing is measured without recorders or signal receivers.
+    """
+    def __init__(self, recorders=()):
+        self.recorders = list(recorders)
+
+    def enabled(self, metric):
+        # without blinker, Flask signals have no receivers
+        return bool(self.recorders or
+                    getattr(_metric_signals[metric], "receivers", None))
+
+    def measure(self, metric, func, *args, **labels):
+        if not self.enabled(metric):
+            return func(*args)
+
+        start = _now()
+        outcome = "ok"
+        try:
+            return func(*args)
+        except HTTPException as e:
+            outcome = e.code
+            raise
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            self.record(metric, _now() - start, outcome, **labels)
+
+    def record(self, metric, duration, outcome, **labels):
+        _metric_signals[metric].send(
+            current_app._get_current_object() if has_app_context() else None,
+            duration=duration, outcome=outcome, **labels)
+        for recorder in self.recorders:
+            recorder.record(metric, duration, outcome, **labels)
+
+
+class MetricsRegistry(object):
+    """
+    In-process registry of Prometheus style metrics: a duration histogram
+    and a channels counter per metric and outcome.
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+               10)
+
+    def __init__(self, prefix="flask_pusher", buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def record(self, metric, duration, outcome, channels=None, **labels):
+        key = (metric, str(outcome))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    "buckets": [0] * len(self.buckets), "sum": 0.0,
+                    "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += duration
+            histogram["count"] += 1
+            if channels is not None:
+                self._channels[key] = self._channels.get(key, 0) + channels
+
+    def render(self):
+        """Render the metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for metric in sorted(set(m for m, o in self._histograms)):
+                name = "%s_%s_seconds" % (self.prefix, metric)
+                lines.append("# TYPE %s histogram" % name)
+                for (m, outcome), h in sorted(self._histograms.items()):
+                    if m != metric:
+                        continue
+                    for bound, count in zip(self.buckets, h["buckets"]):
+                        lines.append('%s_bucket{outcome="%s",le="%s"} %d' % (
+                            name, outcome, bound, count))
+                    lines.append('%s_bucket{outcome="%s",le="+Inf"} %d' % (
+                        name, outcome, h["count"]))
+                    lines.append('%s_sum{outcome="%s"} %s' % (
+                        name, outcome, h["sum"]))
+                    lines.append('%s_count{outcome="%s"} %d' % (
+                        name, outcome, h["count"]))
+
+            for metric in sorted(set(m for m, o in self._channels)):
+                name = "%s_%s_channels_total" % (self.prefix, metric)
+                lines.append("# TYPE %s counter" % name)
+                for (m, outcome), value in sorted(self._channels.items()):
+                    if m == metric:
+                        lines.append('%s{outcome="%s"} %d' % (
+                            name, outcome, value))
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetrics(object):
+    """
+    Summary of the metrics of the current request in `g.pusher_metrics`,
+    as `{metric: {"count": count, "time": seconds}}`.
+    """
+    def record(self, metric, duration, outcome, **labels):
+        if not has_app_context():
+            return
+        summary = g.setdefault("pusher_metrics", {})
+        entry = summary.setdefault(metric, {"count": 0, "time": 0.0})
+        entry["count"] += 1
+        entry["time"] += duration
+
+
+class PayloadTooLarge(ValueError):
+    """The encoded event data is larger than `PUSHER_MAX_PAYLOAD`."""
+
+
+CHUNKED_EVENTS_JS = """\
+function bindChunked(channel, event, callback) {
+  var events = {};
+  channel.bind("chunked-" + event, function (data) {
+    var e = events[data.id] = events[data.id] || {chunks: [], received: 0};
+    e.chunks[data.index] = data.chunk;
+    e.received++;
+    if (data.final) {
+      e.total = data.index + 1;
+    }
+    if (e.total && e.received === e.total) {
+      delete events[data.id];
+      callback(JSON.parse(e.chunks.join("")));
+    }
+  });
+}
+"""
+
+
+class _PayloadEncoder(object):
+    """
+    Encode event data once and check its size before sending it.
+
+    Oversized data is refused with `reject`, passed to the `truncate`
+    callback or sent as a sequence of `chunked-<event>` events with `split`.
+    With `cache_size`, the encoding of the last objects sent is reused, so
+    these objects must not be changed after being sent.
+    """
+    POLICIES = ("reject", "truncate", "split")
+    # room for the metadata of a chunk
+    CHUNK_OVERHEAD = 100
+
+    def __init__(self, json_encoder=None, max_size=10240, oversize="reject",
+                 truncate=None, cache_size=0):
+        if oversize not in self.POLICIES:
+            raise ValueError("Invalid oversize policy: %s" % oversize)
+        if oversize == "split" and max_size <= self.CHUNK_OVERHEAD:
+            raise ValueError("Max payload must be larger than %d bytes to "
+                             "split events" % self.CHUNK_OVERHEAD)
+        self.json_encoder = json_encoder
+        self.max_size = max_size
+        self.oversize = oversize
+        self.truncate = truncate
+        self.cache_size = cache_size
+        self._cache = _LRU(cache_size)
+        self._lock = threading.Lock()
+
+    def encode(self, data):
+        if isinstance(data, string_types) or not self.cache_size:
+            return data_to_string(data, self.json_encoder)
+
+        key = id(data)
+        with self._lock:
+            cached = self._cache.get(key)
+        # the id of a garbage collected object can be reused
+        if cached is not None and cached[0] is data:
+            return cached[1]
+
+        encoded = data_to_string(data, self.json_encoder)
+        with self._lock:
+            self._cache.put(key, (data, encoded))
+        return encoded
+
+    def size(self, encoded):
+        return len(encoded.encode("utf-8"))
+
+    def prepare(self, event_name, data):
+        """Return the `(event_name, encoded_data)` events to send."""
+        encoded = self.encode(data)
+        if self.size(encoded) <= self.max_size:
+            return [(event_name, encoded)]
+
+        if self.oversize == "truncate":
+            encoded = self.encode(self.truncate(data, self.max_size))
+            if self.size(encoded) <= self.max_size:
+                return [(event_name, encoded)]
+        elif self.oversize == "split":
+            return [("chunked-%s" % event_name, chunk)
+                    for chunk in self._split(encoded)]
+
+        raise PayloadTooLarge("Event data has %d bytes, limit is %d" % (
+            self.size(encoded), self.max_size))
+
+    def _split(self, encoded):
+        event_id = uuid.uuid4().hex
+        chunks = []
+        start = 0
+        step = max(1, self.max_size - self.CHUNK_OVERHEAD)
+        while start < len(encoded):
+            length = step
+            while True:
+                part = encoded[start:start + length]
+                chunk = {"id": event_id, "index": len(chunks), "chunk": part,
+                         "final": start + len(part) >= len(encoded)}
+                chunk = data_to_string(chunk, None)
+                size = self.size(chunk)
+                if size <= self.max_size:
+                    break
+                if length == 1:
+                    raise PayloadTooLarge(
+                        "Event data can't be split in chunks of %d bytes" %
+                        self.max_size)
+                # escaped characters, try a smaller part
+                length = max(1, length * self.max_size // size - 1)
+            chunks.append(chunk)
+            start += len(part)
+        return chunks
+
+
+class BroadcastResult(object):
+    """
+    Result of a `broadcast`: the channels of each chunk sent and the
+    `(channels, error)` of each chunk which failed after all retries.
+    """
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+
+    @property
+    def ok(self):
+        return not self.failed
+
+
+class _OccupancyFilter(object):
+    """
+    Drop channels known to be vacant from triggers.
+
+    With `fail_open`, nothing is dropped until the presence state is
+    reconciled with the REST API, because it may be missing channels
+    occupied before the webhooks started to be received.
+    """
+    def __init__(self, presence, fail_open=True):
+        self.presence = presence
+        self.fail_open = fail_open
+        self.suppressed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.presence.synced or not self.fail_open
+
+    def filter(self, channels):
+        occupied = [channel for channel in channels
+                    if self.presence.is_occupied(channel)]
+        dropped = len(channels) - len(occupied)
+        if dropped:
+            with self._lock:
+                self.suppressed += dropped
+        return occupied
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled with `rate` tokens per second, up to `burst`.
+
+    Taking more tokens than available puts the bucket in debt, so requests
+    larger than `burst` are still allowed when the bucket is full.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.blocked_until = 0
+        self._updated = _now()
+
+    def wait_time(self, n=1, now=None):
+        """Seconds to wait before `n` tokens can be taken."""
+        if now is None:
+            now = _now()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        needed = min(n, self.burst)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, n=1):
+        self.tokens -= n
+
+
+class _AuthThrottle(object):
+    """
+    Token bucket per client of the auth endpoint, taking one token per
+    channel. Only the `max_clients` most recent clients are tracked.
+    """
+    def __init__(self, rate, burst=None, max_clients=10000):
+        self.rate = rate
+        self.burst = burst or rate
+        self.max_clients = max_clients
+        self.throttled = 0
+        self._buckets = _LRU(max_clients)
+        self._lock = threading.Lock()
+
+    def acquire(self, key, n=1):
+        """
+        Take `n` tokens of `key`. Return 0 if allowed or the seconds to
+        wait before retrying.
+        """
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets.put(key, bucket)
+            wait = bucket.wait_time(n)
+            if wait > 0:
+                self.throttled += 1
+                return wait
+            bucket.take(n)
+            return 0
+
+
+class _RateLimiter(object):
+    """
+    Client side rate limit of triggered messages, one per channel.
+
+    Each channel has its own bucket with a `channel_share` of the rate, so
+    a hot channel cannot use the whole budget. When the budget is exhausted,
+    `mode` is `block` to wait up to `timeout` seconds, `drop` to skip the
+    trigger or `defer` to send it with the background queue.
+    """
+    MODES = ("block", "drop", "defer")
+
+    def __init__(self, rate, burst=None, channel_share=0.5, mode="block",
+                 timeout=None, max_channels=10000):
+        if mode not in self.MODES:
+            raise ValueError("Invalid rate limit mode: %s" % mode)
+        self.rate = rate
+        self.burst = burst or rate
+        self.channel_share = channel_share
+        self.mode = mode
+        self.timeout = timeout
+        self.max_channels = max_channels
+        self.dropped = 0
+        self._bucket = TokenBucket(self.rate, self.burst)
+        self._channels = _LRU(max_channels)
+        self._lock = threading.Lock()
+
+    def _channel_bucket(self, channel):
+        bucket = self._channels.get(channel)
+        if bucket is None:
+            bucket = TokenBucket(self.rate * self.channel_share,
+                                 max(1, self.burst * self.channel_share))
+            self._channels.put(channel, bucket)
+        return bucket
+
+    def acquire(self, channels, can_defer=False, block=False):
+        """
+        Take one token per channel. Return `False` if the trigger must be
+        dropped or deferred. With `block`, wait whatever the mode.
+        """
+        block = block or self.mode == "block" or (
+            self.mode == "defer" and not can_defer)
+        deadline = None
+        if self.timeout is not None:
+            deadline = _now() + self.timeout
+
+        while True:
+            with self._lock:
+                now = _now()
+                buckets = [self._channel_bucket(c) for c in set(channels)]
+                wait = max([self._bucket.wait_time(len(channels), now)] +
+                           [b.wait_time(1, now) for b in buckets])
+                if wait <= 0:
+                    self._bucket.take(len(channels))
+                    for bucket in buckets:
+                        bucket.take(1)
+                    return True
+                if not block:
+                    self.dropped += len(channels)
+                    return False
+
+            if deadline is not None and now + wait > deadline:
+                from flask_pusher_client import RateLimitExceeded
+                raise RateLimitExceeded("Rate limit exceeded")
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._bucket.blocked_until = max(self._bucket.blocked_until,
+                                             _now() + seconds)
+
+    def send(self, func, *args):
+        """Call the API, pausing for `Retry-After` when rate limited."""
+        from flask_pusher_client import PusherRateLimited
+        try:
+            return func(*args)
+        except PusherRateLimited as e:
+            self.pause(e.retry_after or 1)
+            raise
+
+
+class Signer(object):
+    """
+    Sign and verify messages with a precomputed HMAC-SHA256 key.
+
+    `authenticate` returns the same response as `pusher.Pusher.authenticate`,
+    except `channel_data`: it is encoded as compact JSON with sorted keys,
+    where `authenticate` uses the default separators and key order. The
+    signature matches the `channel_data` sent, so clients are not affected.
+    """
+    def __init__(self, key, secret, json_encoder=None):
+        self.key = key
+        self._hmac = hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+        self._encoder = (json_encoder or JSONEncoder)(
+            separators=(",", ":"), sort_keys=True)
+
+    def sign(self, message):
+        h = self._hmac.copy()
+        h.update(message.encode("utf-8"))
+        return h.hexdigest()
+
+    def verify(self, message, signature):
+        return hmac.compare_digest(signature, self.sign(message))
+
+    def authenticate(self, channel, socket_id, custom_data=None):
+        from pusher.util import (channel_name_re, validate_channel,
+                                 validate_socket_id)
+        channel = validate_channel(channel)
+        if not channel_name_re.match(channel):
+            raise ValueError("Channel should be a valid channel, got: %s"
+                             % channel)
+        socket_id = validate_socket_id(socket_id)
+
+        string_to_sign = "%s:%s" % (socket_id, channel)
+        response = {}
+        if custom_data:
+            custom_data = self._encoder.encode(custom_data)
+            string_to_sign += ":%s" % custom_data
+            response["channel_data"] = custom_data
+
+        response["auth"] = "%s:%s" % (self.key, self.sign(string_to_sign))
+        return response
+
+
+class _ChannelKeys(object):
+    """
+    LRU cache of the shared secrets of encrypted channels and their
+    `SecretBox`, derived from the encryption master key.
+
+    The master key is given on every call, so a rotated key drops every
+    cached secret.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._master_key = None
+        self._entries = _LRU(maxsize)
+        self._lock = threading.Lock()
+
+    def _get(self, channel, master_key):
+        with self._lock:
+            if master_key != self._master_key:
+                self._entries.clear()
+                self._master_key = master_key
+            entry = self._entries.get(channel)
+            if entry is None:
+                entry = self._derive(channel, master_key)
+                self._entries.put(channel, entry)
+            return entry
 
+    @staticmethod
+    def _derive(channel, master_key):
+        import nacl.secret
+        from pusher.crypto import generate_shared_secret
+        from pusher.util import ensure_binary
+        shared_secret = generate_shared_secret(
+            ensure_binary(channel, "channel"), master_key)
+        secret_b64 = base64.b64encode(shared_secret).decode("ascii")
+        return secret_b64, nacl.secret.SecretBox(shared_secret)
 
-class _Pusher(_pusher.Pusher):
+    def secret(self, channel, master_key):
+        """Base64 shared secret of `channel`, as sent in auth responses."""
+        return self._get(channel, master_key)[0]
+
+    def encrypt(self, channel, data, master_key):
+        """Encrypt `data` like `pusher.crypto.encrypt`, as a JSON string."""
+        box = self._get(channel, master_key)[1]
+        nonce = os.urandom(box.NONCE_SIZE)
+        encrypted = box.encrypt(data.encode("utf-8"), nonce)
+        # base64 needs no JSON escaping
+        return '{"nonce": "%s", "ciphertext": "%s"}' % (
+            base64.b64encode(nonce).decode("ascii"),
+            base64.b64encode(encrypted.ciphertext).decode("ascii"))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._master_key = None
+
+
+class _TriggerQueue(object):
     """
-    Pusher client wrapper to get attributes from `_pusher_client`
-    if the attribute does not exist.
+    Bounded in-process queue drained by a worker thread, coalescing pending
+    events in `trigger_batch` calls.
 
-    Provide backward compatibility to `pusher>=1.6`.
+    A batch is sent when it has `batch_size` events or when its oldest event
+    is `flush_interval` seconds old. When the queue is full, `put` blocks up
+    to `timeout` seconds and raises `queue.Full` after that.
     """
+    _STOP = object()
+
+    def __init__(self, client, maxsize, batch_size=BATCH_LIMIT,
+                 flush_interval=0.1, timeout=None):
+        self.client = client
+        self.batch_size = min(batch_size, BATCH_LIMIT)
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize)
+        self._threads = _Threads([(self._run, "flask-pusher-queue")])
+        atexit.register(self.close)
+
+    def put(self, event):
+        self._threads.start()
+        self._queue.put(event, timeout=self.timeout)
+
+    def join(self):
+        """Block until every queued event was sent."""
+        self._queue.join()
+
+    def close(self, timeout=None):
+        """Drain the queue and stop the worker."""
+        for thread in self._threads.stop():
+            self._queue.put(self._STOP)
+            thread.join(timeout)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            event = self._queue.get()
+            if event is self._STOP:
+                self._queue.task_done()
+                break
+
+            batch = [event]
+            deadline = _now() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - _now()
+                if remaining <= 0:
+                    break
+                try:
+                    event = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if event is self._STOP:
+                    self._queue.task_done()
+                    stop = True
+                    break
+                batch.append(event)
+
+            try:
+                self.client._trigger_batch_now(batch, block=True)
+            except Exception:
+                logger.exception("Failed to send %d queued events",
+                                 len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+def _is_rejected(error):
+    """Return if the events are invalid, failing again if retried."""
+    from pusher.errors import PusherBadRequest
+    return isinstance(error, (ValueError, TypeError, PusherBadRequest))
+
+
+class _Spool(object):
+    """
+    Durable SQLite spool of events, sent by a relay thread with
+    `trigger_batch`.
+
+    Events appended at the same time by concurrent requests are written in a
+    single transaction, so they share one fsync. Events are deleted once
+    sent: events left by a crashed process are sent again on restart.
+    Pending events are leased for `lease` seconds while being sent, so
+    processes can share a spool. Events of each Pusher key are sent by the
+    client of that key. `append` raises if the events are not written in
+    `write_timeout` seconds.
+    """
+    _STOP = object()
+
+    def __init__(self, client, path, poll_interval=1.0, lease=30,
+                 batch_size=100, write_timeout=60):
+        self.client = client
+        self.path = path
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.batch_size = batch_size
+        self.write_timeout = write_timeout
+        self._writes = queue.Queue()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._threads = _Threads([(self._write, "flask-pusher-spool"),
+                                  (self._relay, "flask-pusher-relay")])
+        self._connect().close()
+        atexit.register(self.close)
+
+    def _connect(self):
+        import sqlite3
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("CREATE TABLE IF NOT EXISTS pusher_outbox ("
+                     "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                     "key TEXT NOT NULL, "
+                     "event TEXT NOT NULL, "
+                     "lease REAL NOT NULL DEFAULT 0)")
+        conn.execute("CREATE TABLE IF NOT EXISTS pusher_outbox_failed ("
+                     "id INTEGER PRIMARY KEY, "
+                     "key TEXT NOT NULL, "
+                     "event TEXT NOT NULL, "
+                     "error TEXT NOT NULL)")
+        return conn
+
+    def append(self, events):
+        """Write events to the spool, returning once they are durable."""
+        if not events:
+            return
+        self.start()
+        rows = [(self.client.key, _json.dumps(event)) for event in events]
+        item = [rows, threading.Event(), None]
+        self._writes.put(item)
+        if not item[1].wait(self.write_timeout):
+            raise RuntimeError("Timed out writing %d events to the spool"
+                               % len(rows))
+        if item[2] is not None:
+            raise item[2]
+
+    def start(self):
+        """Start the writer and relay threads, sending pending events."""
+        self._threads.start(setup=self._reset)
+
+    def _reset(self):
+        self._stopping = False
+
+    def close(self, timeout=None):
+        """
+        Write pending events and stop the threads. Unsent events stay in
+        the spool.
+        """
+        threads = self._threads.stop()
+        if not threads:
+            return
+        self._stopping = True
+        self._writes.put(self._STOP)
+        self._wake.set()
+        for thread in threads:
+            thread.join(timeout)
+
+    def _write(self):
+        conn = None
+        stop = False
+        while not stop:
+            items = [self._writes.get()]
+            while True:
+                try:
+                    items.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            stop = self._STOP in items
+            items = [item for item in items if item is not self._STOP]
+            if not items:
+                continue
+            try:
+                if conn is None:
+                    # retried with the next events if it can't be opened
+                    conn = self._connect()
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.executemany(
+                        "INSERT INTO pusher_outbox (key, event) "
+                        "VALUES (?, ?)",
+                        [row for item in items for row in item[0]])
+            except Exception as e:
+                logger.exception("Failed to write %d spooled events",
+                                 sum(len(item[0]) for item in items))
+                for item in items:
+                    item[2] = e
+            for item in items:
+                item[1].set()
+            self._wake.set()
+        if conn is not None:
+            conn.close()
+
+    def _relay(self):
+        conn = None
+        while not self._stopping:
+            self._wake.clear()
+            try:
+                if conn is None:
+                    conn = self._connect()
+                while not self._stopping and self._send(conn):
+                    pass
+            except Exception:
+                logger.exception("Failed to read the spool")
+            self._wake.wait(self.poll_interval)
+        if conn is not None:
+            conn.close()
+
+    def _send(self, conn):
+        """Send a batch of pending events, return `False` when done."""
+        key = self.client.key
+        now = time.time()
+        lease = now + self.lease
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, event FROM pusher_outbox "
+                "WHERE key = ? AND lease < ? ORDER BY id LIMIT ?",
+                (key, now, self.batch_size)).fetchall()
+            if rows:
+                conn.execute(
+                    "UPDATE pusher_outbox SET lease = ? "
+                    "WHERE key = ? AND lease < ? AND id BETWEEN ? AND ?",
+                    (lease, key, now, rows[0][0], rows[-1][0]))
+        if not rows:
+            return False
+
+        for i in range(0, len(rows), BATCH_LIMIT):
+            if not self._send_chunk(conn, lease, rows[i:i + BATCH_LIMIT]):
+                # released, retried after `poll_interval`
+                conn.execute(
+                    "UPDATE pusher_outbox SET lease = 0 "
+                    "WHERE key = ? AND lease = ? AND id >= ?",
+                    (key, lease, rows[i][0]))
+                return False
+        return True
+
+    def _send_chunk(self, conn, lease, chunk):
+        """
+        Send spooled events, return `False` if they must be retried.
+        Events refused by the API are moved to `pusher_outbox_failed`.
+        """
+        key = self.client.key
+        try:
+            self.client._trigger_batch_now(
+                [_json.loads(event) for _, event in chunk], block=True)
+        except Exception as e:
+            if not _is_rejected(e):
+                logger.exception("Failed to send %d spooled events",
+                                 len(chunk))
+                return False
+            if len(chunk) > 1:
+                # send them one by one to find the refused events
+                return all(self._send_chunk(conn, lease, [row])
+                           for row in chunk)
+            logger.error("Spooled event %d refused: %s", chunk[0][0], e)
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(
+                    "INSERT INTO pusher_outbox_failed (id, key, event, error) "
+                    "VALUES (?, ?, ?, ?)",
+                    (chunk[0][0], key, chunk[0][1], repr(e)))
+                conn.execute("DELETE FROM pusher_outbox WHERE id = ?",
+                             (chunk[0][0],))
+            return True
+        # checkpoint, sent events are not sent again after a crash
+        conn.execute(
+            "DELETE FROM pusher_outbox "
+            "WHERE key = ? AND lease = ? AND id BETWEEN ? AND ?",
+            (key, lease, chunk[0][0], chunk[-1][0]))
+        return True
+
+
+class MemoryAuthCache(object):
+    """
+    In-process auth cache, evicting the least recently used entries after
+    `maxsize` entries.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = _LRU(maxsize)
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def get(self, user, channel):
+        key = (user, channel)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < _now():
+                self._remove(key)
+                return None
+            return value
+
+    def set(self, user, channel, value, ttl):
+        key = (user, channel)
+        with self._lock:
+            evicted = self._entries.put(key, (_now() + ttl, value))
+            self._users.setdefault(user, set()).add(channel)
+            for evicted_key, _ in evicted:
+                self._remove(evicted_key)
+
+    def delete(self, user, channel=None):
+        with self._lock:
+            if channel is not None:
+                self._remove((user, channel))
+                return
+            for channel in list(self._users.get(user, ())):
+                self._remove((user, channel))
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        user, channel = key
+        channels = self._users.get(user)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self._users[user]
+
+
+class RedisAuthCache(object):
+    """
+    Auth cache shared between processes, stored in a Redis hash per user.
+
+    Works with any client implementing `hget`, `hset`, `hdel`, `delete` and
+    `expire` like `redis.Redis`.
+    """
+    def __init__(self, redis, prefix="flask-pusher:auth:"):
+        self.redis = redis
+        self.prefix = prefix
+
+    def _key(self, user):
+        return "%s%s" % (self.prefix, user)
+
+    def get(self, user, channel):
+        raw = self.redis.hget(self._key(user), channel)
+        if raw is None:
+            return None
+        if isinstance(raw, bytes):
+            raw = raw.decode("utf-8")
+        expires, value = json.loads(raw)
+        if expires < time.time():
+            self.redis.hdel(self._key(user), channel)
+            return None
+        return value
+
+    def set(self, user, channel, value, ttl):
+        key = self._key(user)
+        self.redis.hset(key, channel, json.dumps([time.time() + ttl, value]))
+        self.redis.expire(key, int(ttl) + 1)
+
+    def delete(self, user, channel=None):
+        if channel is None:
+            self.redis.delete(self._key(user))
+        else:
+            self.redis.hdel(self._key(user), channel)
+
+
+class CircuitBreaker(object):
+    """
+    Stop sending requests to the Pusher API while it fails.
+
+    Requests are counted in a rolling window of `window` seconds. Errors,
+    except refused requests (4xx), and requests slower than `slow` seconds
+    are failures. After `min_requests` requests, when the rate of failures
+    reaches `threshold`, the circuit opens: requests fail fast with
+    `CircuitOpen` for `reset_timeout` seconds. Then a single probe request
+    is sent (half-open), closing the circuit when it succeeds.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, window=10, threshold=0.5, min_requests=10, slow=None,
+                 reset_timeout=30):
+        self.window = window
+        self.threshold = threshold
+        self.min_requests = min_requests
+        self.slow = slow
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened_at = None
+        # [second, requests, failures]
+        self._buckets = collections.deque()
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """State and counts of the rolling window, for health checks."""
+        with self._lock:
+            self._expire(_now())
+            return {
+                "state": self.state,
+                "requests": sum(b[1] for b in self._buckets),
+                "failures": sum(b[2] for b in self._buckets),
+            }
+
+    def call(self, func, *args):
+        probe = self._before()
+        start = _now()
+        try:
+            result = func(*args)
+        except BaseException as e:
+            # gevent `Timeout` is a `BaseException`, a probe must not be
+            # left half-open
+            self._after(start, probe, self._is_failure(e))
+            raise
+        self._after(start, probe, False)
+        return result
+
+    @staticmethod
+    def _is_failure(error):
+        from pusher.errors import (PusherError, PusherBadStatus)
+        from flask_pusher_client import PusherRateLimited
+        if isinstance(error, PusherRateLimited):
+            return False
+        return isinstance(error, PusherBadStatus) or \
+            not isinstance(error, PusherError)
+
+    def _before(self):
+        """Return `True` for a probe, raise `CircuitOpen` when open."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.OPEN and \
+                    _now() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+        from flask_pusher_client import CircuitOpen
+        raise CircuitOpen("Pusher circuit is %s" % self.state)
+
+    def _after(self, start, probe, failed):
+        now = _now()
+        if self.slow is not None and now - start > self.slow:
+            failed = True
+        with self._lock:
+            if probe:
+                if failed:
+                    self._open(now)
+                else:
+                    logger.info("Pusher circuit closed")
+                    self.state = self.CLOSED
+                    self._buckets.clear()
+                return
+
+            second = int(now)
+            if not self._buckets or self._buckets[-1][0] != second:
+                self._buckets.append([second, 0, 0])
+            bucket = self._buckets[-1]
+            bucket[1] += 1
+            bucket[2] += failed
+            if not failed or self.state != self.CLOSED:
+                return
+            self._expire(now)
+            requests = sum(b[1] for b in self._buckets)
+            failures = sum(b[2] for b in self._buckets)
+            if requests >= self.min_requests and \
+                    failures >= requests * self.threshold:
+                self._open(now)
+
+    def _open(self, now):
+        logger.warning("Pusher circuit opened for %ss", self.reset_timeout)
+        self.state = self.OPEN
+        self.opened_at = now
+
+    def _expire(self, now):
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            self._buckets.popleft()
+
+
+class _BreakerBackend(object):
+    """Backend sending the requests of another one through a breaker."""
+    def __init__(self, backend, breaker):
+        self.backend = backend
+        self.breaker = breaker
+
     def __getattr__(self, attr):
-        client = self._pusher_client
-        return getattr(client, attr)
+        return getattr(self.backend, attr)
+
+    def send_request(self, request):
+        return self.breaker.call(self.backend.send_request, request)
+
+
+class _Collector(object):
+    """
+    Collect the triggers made in a request, to send them with the fewest
+    `trigger` and `trigger_batch` calls at the end of the request.
+
+    Events of the same channel, event name and socket id are merged with
+    `merge(channel, event_name, previous_data, data)`, or all kept without
+    `merge`. A merged event takes the place of the last trigger.
+    """
+    def __init__(self, merge=None):
+        self.merge = merge
+
+    def collect(self, client, channels, event_name, data, socket_id):
+        """Collect a trigger, return `False` outside of a request."""
+        if not has_request_context():
+            return False
+        events = g.get("_pusher_collected")
+        if events is None:
+            events = g._pusher_collected = collections.OrderedDict()
+        for channel in _channel_list(channels):
+            merged = data
+            if self.merge is None:
+                key = len(events)
+            else:
+                key = (id(client), channel, event_name, socket_id)
+                previous = events.pop(key, None)
+                if previous is not None:
+                    merged = self.merge(channel, event_name,
+                                        previous[1]["data"], data)
+            event = {"channel": channel, "name": event_name, "data": merged}
+            if socket_id:
+                event["socket_id"] = socket_id
+            events[key] = (client, event)
+        return True
+
+
+class _Flight(object):
+    """A fetch in progress, waited by concurrent readers of the same key."""
+    def __init__(self, generation):
+        self.generation = generation
+        self.value = None
+        self.error = None
+        self._done = threading.Event()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def finish(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self._done.set()
+
+
+class _InfoCache(object):
+    """
+    Read-through cache of `channels_info`, `channel_info` and `users_info`.
+
+    Concurrent misses of a key wait for a single fetch. For `stale` seconds
+    after `ttl`, the cached value is returned while a background thread
+    fetches it again. After `maxsize` entries, the least recently used are
+    dropped. Webhook events drop the entries of their channels.
+    """
+    # webhook events changing the info of their channel
+    EVENTS = frozenset(["channel_occupied", "channel_vacated", "member_added",
+                        "member_removed", "subscription_count"])
+
+    def __init__(self, ttl, stale=0, maxsize=1024):
+        self.ttl = ttl
+        self.stale = stale
+        self.maxsize = maxsize
+        self._entries = _LRU(maxsize)
+        self._flights = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if not ttl:
+            return fetch()
+
+        refresh = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, fetched = entry
+                age = _now() - fetched
+                if age < ttl:
+                    return value
+                if age < ttl + self.stale:
+                    if key not in self._flights:
+                        refresh = self._start_flight(key)
+                    else:
+                        return value
+            if refresh is None:
+                flight = self._flights.get(key)
+                if flight is not None:
+                    leader = False
+                else:
+                    flight = self._start_flight(key)
+                    leader = True
+
+        if refresh is not None:
+            thread = threading.Thread(target=self._fetch,
+                                      args=(key, fetch, refresh),
+                                      name="flask-pusher-info-refresh")
+            thread.daemon = True
+            thread.start()
+            return value
+        if not leader:
+            return flight.wait()
+        return self._fetch(key, fetch, flight, reraise=True)
+
+    def _start_flight(self, key):
+        flight = self._flights[key] = _Flight(self._generation)
+        return flight
+
+    def _fetch(self, key, fetch, flight, reraise=False):
+        try:
+            value = fetch()
+        except Exception as e:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.finish(error=e)
+            if reraise:
+                raise
+            logger.exception("Failed to refresh %s", key[0])
+            return None
+
+        with self._lock:
+            self._flights.pop(key, None)
+            # an invalidation during the fetch may make the value stale
+            if flight.generation == self._generation:
+                self._entries.put(key, (value, _now()))
+        flight.finish(value)
+        return value
+
+    def invalidate(self, channels=None):
+        """Drop the entries of some channels, or all entries."""
+        with self._lock:
+            self._generation += 1
+            if channels is None:
+                self._entries.clear()
+                return
+            for key in list(self._entries):
+                # `channels_info` lists every channel
+                if key[0] == "channels_info" or key[1] in channels:
+                    self._entries.pop(key)
+
+    def apply(self, payload):
+        """Drop the entries of the channels changed by webhook events."""
+        channels = set(event.get("channel")
+                       for event in payload.get("events", ())
+                       if event.get("name") in self.EVENTS)
+        if channels:
+            self.invalidate(channels)
+
+
+class _ReplayGuard(object):
+    """
+    Remember keys seen in the last `window` seconds.
+
+    Keys are kept in insertion order, so expired keys are always at the
+    start and memory is bounded by the traffic of one window, capped by
+    `maxsize` keys.
+    """
+    def __init__(self, window, maxsize=100000):
+        self.window = window
+        self.maxsize = maxsize
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key):
+        """Return if the key was already seen, remembering it otherwise."""
+        now = _now()
+        with self._lock:
+            while self._seen:
+                oldest = next(iter(self._seen))
+                if self._seen[oldest] > now - self.window and \
+                        len(self._seen) < self.maxsize:
+                    break
+                del self._seen[oldest]
+
+            if key in self._seen:
+                return True
+            self._seen[key] = now
+            return False
+
+    def forget(self, key):
+        with self._lock:
+            self._seen.pop(key, None)
+
+
+class _WorkerPool(object):
+    """
+    Fixed number of daemon threads consuming a bounded queue of jobs.
+
+    `submit` raises `queue.Full` when `maxsize` jobs are pending. Pending
+    jobs are run before the process exits.
+    """
+    _STOP = object()
+
+    def __init__(self, workers, maxsize=0, name="flask-pusher-worker"):
+        self.workers = workers
+        self.name = name
+        self._queue = queue.Queue(maxsize)
+        self._threads = _Threads([(self._run, name)] * workers)
+        atexit.register(self.close)
+
+    def submit(self, func, *args):
+        self._threads.start()
+        self._queue.put_nowait((func, args))
+
+    def join(self):
+        """Block until every submitted job was run."""
+        self._queue.join()
+
+    def close(self, timeout=None):
+        """Run pending jobs and stop the workers."""
+        threads = self._threads.stop()
+        for _ in threads:
+            self._queue.put(self._STOP)
+        for thread in threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is self._STOP:
+                    return
+                func, args = job
+                try:
+                    func(*args)
+                except Exception:
+                    logger.exception("Failed to run %s job", self.name)
+            finally:
+                self._queue.task_done()
+
+
+class MemoryPresenceStorage(object):
+    """
+    In-process storage of occupied channels and presence channel members.
+
+    Member sets are immutable and replaced on change, so they are returned
+    without a copy.
+    """
+    def __init__(self):
+        self._channels = set()
+        self._members = {}
+        self._lock = threading.Lock()
+
+    def occupy(self, channel):
+        with self._lock:
+            self._channels.add(channel)
+
+    def vacate(self, channel):
+        with self._lock:
+            self._channels.discard(channel)
+            self._members.pop(channel, None)
+
+    def add_member(self, channel, user_id):
+        with self._lock:
+            self._channels.add(channel)
+            members = self._members.get(channel, frozenset())
+            self._members[channel] = members | frozenset([user_id])
+
+    def remove_member(self, channel, user_id):
+        with self._lock:
+            members = self._members.get(channel, frozenset())
+            self._members[channel] = members - frozenset([user_id])
+
+    def members(self, channel):
+        return self._members.get(channel, frozenset())
+
+    def is_occupied(self, channel):
+        return channel in self._channels
+
+    def channels(self):
+        return frozenset(self._channels)
+
+    def replace(self, channels):
+        """Replace the state with a `{channel: members}` dict."""
+        members = dict((channel, frozenset(users))
+                       for channel, users in channels.items() if users)
+        with self._lock:
+            self._channels = set(channels)
+            self._members = members
+
+
+class RedisPresenceStorage(object):
+    """
+    Presence storage shared between processes, stored in Redis sets.
+
+    Works with any client implementing `sadd`, `srem`, `smembers`,
+    `sismember`, `delete` and a transactional `pipeline` like
+    `redis.Redis`.
+    """
+    def __init__(self, redis, prefix="flask-pusher:presence:"):
+        self.redis = redis
+        self.prefix = prefix
+        self._channels_key = prefix + "channels"
+
+    def _members_key(self, channel):
+        return "%smembers:%s" % (self.prefix, channel)
+
+    def occupy(self, channel):
+        self.redis.sadd(self._channels_key, channel)
+
+    def vacate(self, channel):
+        self.redis.srem(self._channels_key, channel)
+        self.redis.delete(self._members_key(channel))
+
+    def add_member(self, channel, user_id):
+        self.redis.sadd(self._channels_key, channel)
+        self.redis.sadd(self._members_key(channel), user_id)
+
+    def remove_member(self, channel, user_id):
+        self.redis.srem(self._members_key(channel), user_id)
+
+    def members(self, channel):
+        return frozenset(self._decode(m) for m in
+                         self.redis.smembers(self._members_key(channel)))
+
+    def is_occupied(self, channel):
+        return bool(self.redis.sismember(self._channels_key, channel))
+
+    def channels(self):
+        return frozenset(self._decode(c) for c in
+                         self.redis.smembers(self._channels_key))
+
+    def replace(self, channels):
+        # MULTI/EXEC, other processes never see a partial state
+        pipe = self.redis.pipeline()
+        for channel in self.channels():
+            pipe.delete(self._members_key(channel))
+        pipe.delete(self._channels_key)
+        for channel, members in channels.items():
+            pipe.sadd(self._channels_key, channel)
+            if members:
+                pipe.sadd(self._members_key(channel), *members)
+        pipe.execute()
+
+    @staticmethod
+    def _decode(value):
+        if isinstance(value, bytes):
+            return value.decode("utf-8")
+        return value
+
+
+class Presence(object):
+    """
+    Occupied channels and presence channel members, maintained from the
+    `channel_existence` and `presence` webhooks.
+    """
+    def __init__(self):
+        self.storage = None
+        self.synced = False
+        self._app = None
+        self._interval = None
+        self._reconciler = _Threads([(self._reconcile_forever,
+                                      "flask-pusher-presence")])
+
+    def init_app(self, app):
+        storage = app.config.get('PUSHER_PRESENCE_STORE')
+        if not storage:
+            return
+        if storage is True:
+            storage = MemoryPresenceStorage()
+        self.storage = storage
+        self._app = app
+        self._interval = app.config.get('PUSHER_PRESENCE_RECONCILE_INTERVAL')
+
+    @property
+    def enabled(self):
+        return self.storage is not None
+
+    def members(self, channel):
+        self._ensure_reconciler()
+        return self.storage.members(channel)
+
+    def count(self, channel):
+        return len(self.members(channel))
+
+    def is_occupied(self, channel):
+        self._ensure_reconciler()
+        return self.storage.is_occupied(channel)
+
+    def channels(self):
+        self._ensure_reconciler()
+        return self.storage.channels()
+
+    def apply(self, payload):
+        """Apply the events of a webhook payload."""
+        for event in payload.get("events", ()):
+            name = event.get("name")
+            channel = event.get("channel")
+            if name == "channel_occupied":
+                self.storage.occupy(channel)
+            elif name == "channel_vacated":
+                self.storage.vacate(channel)
+            elif name == "member_added":
+                self.storage.add_member(channel, event["user_id"])
+            elif name == "member_removed":
+                self.storage.remove_member(channel, event["user_id"])
+
+    def reconcile(self, client=None):
+        """Replace the state with the channels fetched from the REST API."""
+        if client is None:
+            client = current_app.extensions["pusher"]
+        channels = {}
+        # bypass the info cache
+        kwargs = {"cache_ttl": 0} if client.info_cache is not None else {}
+        for channel in client.channels_info(**kwargs).get("channels", {}):
+            members = None
+            if channel.startswith("presence-"):
+                users = client.users_info(channel, **kwargs).get("users", ())
+                members = [user["id"] for user in users]
+            channels[channel] = members
+        self.storage.replace(channels)
+        self.synced = True
+
+    def _ensure_reconciler(self):
+        if self._interval:
+            self._reconciler.start()
+
+    def _reconcile_forever(self):
+        while True:
+            try:
+                with self._app.app_context():
+                    self.reconcile()
+            except Exception:
+                logger.exception("Failed to reconcile presence state")
+            time.sleep(self._interval)
+
+
+class _TenantClients(object):
+    """
+    Clients of the tenants by Pusher key, closing the least recently used
+    after `maxsize` clients.
+    """
+    def __init__(self, factory, maxsize=128):
+        self.factory = factory
+        self.maxsize = maxsize
+        self._entries = _LRU(maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return entry[1]
+
+    def resolve(self, credentials):
+        """Return the client of these credentials, built on first use."""
+        key = credentials["key"]
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] != credentials:
+                # credentials changed, rebuild the client
+                evicted.append(entry[1])
+                entry = None
+            if entry is None:
+                entry = (dict(credentials), self.factory(**credentials))
+                for _, (_, client) in self._entries.put(key, entry):
+                    evicted.append(client)
+        for client in evicted:
+            client.close()
+        return entry[1]
+
+
+def _call(handler, *args):
+    """Call a user handler, running it in an event loop if it is async."""
+    ensure_sync = getattr(current_app, "ensure_sync", None)
+    if ensure_sync is not None:
+        handler = ensure_sync(handler)
+    return handler(*args)
 
 
 class Pusher(object):
+    # `PooledBackend` if not defined
+    default_backend = None
+    # `flask_pusher_client._Pusher` if not defined
+    client_class = None
+    presence_class = Presence
 
     def __init__(self, app=None, url_prefix="/pusher"):
         self.app = app
         self._auth_handler = None
+        self._auth_batch_handler = None
         self._channel_data_handler = None
+        self._identity_handler = None
+        self._truncate_handler = None
+        self._merge_handler = None
+        self._fallback_handler = None
+        self._tenant_handler = None
+        self._auth_cache = None
+        self._auth_cache_ttl = None
+        self._auth_max_channels = CHANNELS_LIMIT
+        self._auth_throttle = None
+        self._auth_throttle_key = "socket_id"
         self._blueprint = Blueprint('pusher', __name__, url_prefix=url_prefix)
         self.webhooks = Webhooks(self)
+        self.presence = self.presence_class()
+        self._lock = threading.Lock()
 
         if app is not None:
             self.init_app(app)
@@ -56,6 +1734,71 @@ class Pusher(object):
         app.config.setdefault("PUSHER_PORT", '')
         app.config.setdefault("PUSHER_AUTH", '/auth')
 
+        self._auth_cache_ttl = app.config.get('PUSHER_AUTH_CACHE_TTL')
+        if self._auth_cache_ttl:
+            self._auth_cache = app.config.get('PUSHER_AUTH_CACHE_STORE')
+            if self._auth_cache is None:
+                self._auth_cache = MemoryAuthCache(
+                    app.config.get('PUSHER_AUTH_CACHE_SIZE', 1024))
+
+        self._auth_max_channels = app.config.get('PUSHER_AUTH_MAX_CHANNELS',
+                                                 CHANNELS_LIMIT)
+        auth_rate = app.config.get('PUSHER_AUTH_RATE_LIMIT')
+        if auth_rate:
+            self._auth_throttle = _AuthThrottle(
+                auth_rate,
+                burst=app.config.get('PUSHER_AUTH_RATE_LIMIT_BURST'),
+                max_clients=app.config.get('PUSHER_AUTH_RATE_LIMIT_CLIENTS',
+                                           10000),
+            )
+            self._auth_throttle_key = app.config.get(
+                'PUSHER_AUTH_RATE_LIMIT_KEY', "socket_id")
+            if self._auth_throttle_key not in ("socket_id", "user"):
+                raise ValueError("Invalid PUSHER_AUTH_RATE_LIMIT_KEY: %s" %
+                                 self._auth_throttle_key)
+
+        metrics_endpoint = app.config.get('PUSHER_METRICS_ENDPOINT')
+        if metrics_endpoint:
+            registry = [r for r in self._recorders(app)
+                        if isinstance(r, MetricsRegistry)]
+            if not registry:
+                raise ValueError("PUSHER_METRICS_ENDPOINT requires a "
+                                 "MetricsRegistry in PUSHER_METRICS")
+            self._blueprint.add_url_rule(
+                metrics_endpoint, "metrics",
+                lambda: current_app.response_class(
+                    registry[0].render(),
+                    mimetype="text/plain; version=0.0.4"))
+
+        if app.config.get('PUSHER_SKIP_VACANT'):
+            app.config.setdefault('PUSHER_PRESENCE_STORE', True)
+        self.webhooks.init_app(app)
+        self.presence.init_app(app)
+        self._make_blueprint(app.config["PUSHER_AUTH"])
+        app.register_blueprint(self._blueprint)
+
+        if not hasattr(app, "extensions"):
+            app.extensions = {}
+        app.extensions["pusher_tenants"] = _TenantClients(
+            lambda **credentials: self._make_client(app, **credentials),
+            app.config.get('PUSHER_TENANT_CACHE_SIZE', 128))
+        if app.config.get('PUSHER_LAZY'):
+            # built on first access, see `_lazy_client`
+            app.extensions["pusher"] = LocalProxy(
+                lambda: self._lazy_client(app))
+        else:
+            app.extensions["pusher"] = self._make_client(app)
+
+    @staticmethod
+    def _recorders(app):
+        recorders = app.config.get('PUSHER_METRICS') or ()
+        if not isinstance(recorders, (list, tuple)):
+            recorders = [recorders]
+        return recorders
+
+    def _make_client(self, app, **credentials):
+        from flask_pusher_client import _Pusher, PooledBackend
+
         pusher_kwargs = dict(
             app_id=app.config["PUSHER_APP_ID"],
             key=app.config["PUSHER_KEY"],
@@ -77,8 +1820,16 @@ class Pusher(object):
             pusher_kwargs["cluster"] = cluster
 
         backend = app.config.get('PUSHER_BACKEND')
-        if backend is not None:
-            pusher_kwargs["backend"] = backend
+        if backend is None:
+            backend = self.default_backend or PooledBackend
+        pusher_kwargs["backend"] = backend
+        if isinstance(backend, type) and issubclass(backend, PooledBackend):
+            for key, option in (('PUSHER_POOL_SIZE', "pool_connections"),
+                                ('PUSHER_POOL_MAXSIZE', "pool_maxsize"),
+                                ('PUSHER_POOL_RETRIES', "retries")):
+                value = app.config.get(key)
+                if value is not None:
+                    pusher_kwargs[option] = value
 
         notification_host = app.config.get('PUSHER_NOTIFICATION_HOST')
         if notification_host is not None:
@@ -100,24 +1851,306 @@ class Pusher(object):
         backend_options = app.config.get('PUSHER_BACKEND_OPTIONS')
         if backend_options is not None:
             pusher_kwargs.update(backend_options)
+        pusher_kwargs.update(credentials)
 
-        client = _Pusher(**pusher_kwargs)
+        client = (self.client_class or _Pusher)(**pusher_kwargs)
+        client.signer = Signer(client.key, client.secret,
+                               pusher_kwargs["json_encoder"])
 
-        self._make_blueprint(app.config["PUSHER_AUTH"])
-        app.register_blueprint(self._blueprint)
+        channel_keys_size = app.config.get('PUSHER_CHANNEL_KEYS_CACHE_SIZE',
+                                           1024)
+        # pusher<2.1 has no encryption master key
+        if (channel_keys_size and getattr(client._pusher_client,
+                                          "_encryption_master_key", None)):
+            client.channel_keys = _ChannelKeys(channel_keys_size)
 
-        if not hasattr(app, "extensions"):
-            app.extensions = {}
-        app.extensions["pusher"] = client
+        queue_size = app.config.get('PUSHER_QUEUE_SIZE')
+        if queue_size:
+            client.queue = _TriggerQueue(
+                client, queue_size,
+                batch_size=app.config.get('PUSHER_QUEUE_BATCH_SIZE',
+                                          BATCH_LIMIT),
+                flush_interval=app.config.get('PUSHER_QUEUE_FLUSH_INTERVAL',
+                                              0.1),
+                timeout=app.config.get('PUSHER_QUEUE_TIMEOUT'),
+            )
+
+        outbox = app.config.get('PUSHER_OUTBOX')
+        if outbox:
+            client.spool = _Spool(
+                client, outbox,
+                poll_interval=app.config.get('PUSHER_OUTBOX_POLL_INTERVAL',
+                                             1.0),
+                lease=app.config.get('PUSHER_OUTBOX_LEASE', 30),
+                write_timeout=app.config.get('PUSHER_OUTBOX_WRITE_TIMEOUT',
+                                             60),
+            )
+            # send the events left by a previous process
+            client.spool.start()
+
+        if app.config.get('PUSHER_CIRCUIT_BREAKER'):
+            client.breaker = CircuitBreaker(
+                window=app.config.get('PUSHER_CIRCUIT_WINDOW', 10),
+                threshold=app.config.get('PUSHER_CIRCUIT_THRESHOLD', 0.5),
+                min_requests=app.config.get('PUSHER_CIRCUIT_MIN_REQUESTS',
+                                            10),
+                slow=app.config.get('PUSHER_CIRCUIT_SLOW'),
+                reset_timeout=app.config.get('PUSHER_CIRCUIT_RESET_TIMEOUT',
+                                             30),
+            )
+            http = client._pusher_client.http
+            client._pusher_client.http = _BreakerBackend(http, client.breaker)
+            client.fallback = self._circuit_fallback
+
+        if app.config.get('PUSHER_COLLECT'):
+            merge = app.config.get('PUSHER_COLLECT_MERGE', "last")
+            if merge not in ("last", "all"):
+                raise ValueError("Invalid PUSHER_COLLECT_MERGE: %s" % merge)
+            client.collector = _Collector(
+                self._merge if merge == "last" else None)
+
+        info_cache_ttl = app.config.get('PUSHER_INFO_CACHE_TTL')
+        if info_cache_ttl:
+            client.info_cache = _InfoCache(
+                info_cache_ttl,
+                stale=app.config.get('PUSHER_INFO_CACHE_STALE', 0),
+                maxsize=app.config.get('PUSHER_INFO_CACHE_SIZE', 1024),
+            )
+
+        recorders = self._recorders(app)
+        if recorders:
+            client.metrics = _Metrics(recorders)
+
+        client.payload = _PayloadEncoder(
+            pusher_kwargs["json_encoder"],
+            max_size=app.config.get('PUSHER_MAX_PAYLOAD', 10240),
+            oversize=app.config.get('PUSHER_OVERSIZE', "reject"),
+            truncate=self._truncate,
+            cache_size=app.config.get('PUSHER_ENCODE_CACHE_SIZE', 0),
+        )
+
+        broadcast_workers = app.config.get('PUSHER_BROADCAST_WORKERS', 4)
+        if broadcast_workers > 1:
+            client.broadcast_pool = _WorkerPool(
+                broadcast_workers, name="flask-pusher-broadcast")
+
+        rate_limit = app.config.get('PUSHER_RATE_LIMIT')
+        if rate_limit:
+            client.limiter = _RateLimiter(
+                rate_limit,
+                burst=app.config.get('PUSHER_RATE_LIMIT_BURST'),
+                channel_share=app.config.get(
+                    'PUSHER_RATE_LIMIT_CHANNEL_SHARE', 0.5),
+                mode=app.config.get('PUSHER_RATE_LIMIT_MODE', "block"),
+                timeout=app.config.get('PUSHER_RATE_LIMIT_TIMEOUT'),
+            )
+
+        if app.config.get('PUSHER_SKIP_VACANT'):
+            client.occupancy = _OccupancyFilter(
+                self.presence,
+                app.config.get('PUSHER_SKIP_VACANT_FAIL_OPEN', True))
+        return client
+
+    def _lazy_client(self, app):
+        with self._lock:
+            client = app.extensions["pusher"]
+            if isinstance(client, LocalProxy):
+                client = app.extensions["pusher"] = self._make_client(app)
+        return client
 
     @property
     def client(self):
-        return current_app.extensions.get("pusher")
+        if self._tenant_handler is not None and has_request_context():
+            client = g.get("_pusher_client")
+            if client is None:
+                client = g._pusher_client = self._tenant_client(None)
+            return client
+        return self._app_client()
+
+    def _app_client(self):
+        client = current_app.extensions.get("pusher")
+        if isinstance(client, LocalProxy):
+            client = client._get_current_object()
+        return client
+
+    def _tenant_client(self, key):
+        tenants = current_app.extensions["pusher_tenants"]
+        if key is not None:
+            client = tenants.get(key)
+            if client is not None:
+                return client
+        credentials = _call(self._tenant_handler, key)
+        if not credentials:
+            return self._app_client()
+        return tenants.resolve(credentials)
+
+    def _webhook_client(self, key):
+        """Return the client of the tenant of a webhook."""
+        if self._tenant_handler is not None:
+            g._pusher_client = self._tenant_client(key)
+        return self.client
+
+    def tenant(self, handler):
+        """
+        Pick the Pusher app of a tenant. The handler receives the Pusher key
+        of a webhook, or `None` for other requests, and returns the client
+        arguments (`app_id`, `key`, `secret`, `cluster`, ...) of the tenant,
+        or `None` for the app configuration. The clients are cached by key.
+        """
+        self._tenant_handler = handler
+        return handler
+
+    def enqueue(self, channels, event_name, data, socket_id=None):
+        return self.client.enqueue(channels, event_name, data, socket_id)
+
+    def broadcast(self, channels, event_name, data, socket_id=None,
+                  retries=1):
+        return self.client.broadcast(channels, event_name, data, socket_id,
+                                     retries)
+
+    def outbox(self, channels, event_name, data, socket_id=None):
+        """
+        Trigger an event once the request succeeds. The events of a failed
+        request are dropped. With `PUSHER_OUTBOX`, events are written to a
+        durable spool and sent by a background relay, else they are sent
+        with `trigger_batch`. Outside of a request, events are spooled or
+        sent right away.
+        """
+        client = self.client
+        events = [(client, event) for event in client._encode_events(
+            channels, event_name, data, socket_id)]
+
+        if has_request_context():
+            g.setdefault("_pusher_outbox", []).extend(events)
+        else:
+            self._flush_outbox(events)
+
+    def _flush_outbox(self, events, spool=True):
+        clients = collections.OrderedDict()
+        for client, event in events:
+            clients.setdefault(id(client), (client, []))[1].append(event)
+        for client, batch in clients.values():
+            if spool and client.spool is not None:
+                client.spool.append(batch)
+                continue
+            for i in range(0, len(batch), BATCH_LIMIT):
+                client._trigger_batch_now(batch[i:i + BATCH_LIMIT],
+                                          block=True)
+
+    def _flush_collected(self, events):
+        """
+        Send collected `(client, event)` pairs. Events with the same name,
+        data and socket id are sent as multi-channel triggers, without
+        changing the order of the events of a channel. The other events are
+        sent with `trigger_batch`.
+        """
+        from flask_pusher_client import is_encrypted_channel
+        groups = []
+        open_groups = {}
+        last_group = {}
+        for client, event in events:
+            channel = event["channel"]
+            if client.payload is not None:
+                data = client.payload.encode(event["data"])
+            else:
+                data = data_to_string(event["data"], client._json_encoder)
+            key = (id(client), event["name"], data, event.get("socket_id"))
+            if is_encrypted_channel(channel):
+                # encrypted events are sent to a single channel
+                key += (channel,)
+            index = open_groups.get(key)
+            # a channel already in the group (merge "all") or in a later
+            # group starts a new one
+            if index is None or \
+                    last_group.get((id(client), channel), -1) >= index or \
+                    len(groups[index][1]) >= CHANNELS_LIMIT:
+                index = open_groups[key] = len(groups)
+                groups.append((client, [], dict(event, data=data)))
+            groups[index][1].append(channel)
+            last_group[(id(client), channel)] = index
+
+        pending = []
+        for client, channels, event in groups:
+            if len(channels) == 1:
+                pending.append((client, event))
+                continue
+            self._flush_outbox(pending, spool=False)
+            pending = []
+            client._trigger_now(channels, event["name"], event["data"],
+                                event.get("socket_id"), block=True)
+        self._flush_outbox(pending, spool=False)
 
     def auth(self, handler):
         self._auth_handler = handler
         return handler
 
+    def auth_batch(self, handler):
+        """
+        Authorize all channels of a request at once. The handler receives a
+        list of `(channel_name, socket_id)` pairs and returns a dict mapping
+        channel names to a boolean. Overrides `auth`.
+        """
+        self._auth_batch_handler = handler
+        return handler
+
+    def truncate(self, handler):
+        """
+        Shrink oversized event data when `PUSHER_OVERSIZE` is `truncate`.
+        The handler receives the data and the max size in bytes.
+        """
+        self._truncate_handler = handler
+        return handler
+
+    def _truncate(self, data, max_size):
+        if self._truncate_handler is None:
+            return data
+        return self._truncate_handler(data, max_size)
+
+    def circuit_fallback(self, handler):
+        """
+        Handle the triggers refused by the open circuit breaker, instead of
+        raising `CircuitOpen`. The handler receives the list of events and
+        its result is returned by `trigger` or `trigger_batch`.
+        """
+        self._fallback_handler = handler
+        return handler
+
+    def _circuit_fallback(self, events, error):
+        if self._fallback_handler is None:
+            raise error
+        return self._fallback_handler(events)
+
+    def merge(self, handler):
+        """
+        Merge the data of triggers of the same channel and event collected
+        in a request. The handler receives the channel, the event name, the
+        previous and the new data, and returns the data to send.
+        """
+        self._merge_handler = handler
+        return handler
+
+    def _merge(self, channel, event_name, previous, data):
+        if self._merge_handler is None:
+            return data
+        return self._merge_handler(channel, event_name, previous, data)
+
+    def identity(self, handler):
+        """
+        Identify the current user for the auth cache. The handler returns a
+        user key, or `None` to skip the cache.
+        """
+        self._identity_handler = handler
+        return handler
+
+    def invalidate(self, user, channel=None, key=None):
+        """
+        Drop cached auth results of an user, for one or all channels. With
+        `@pusher.tenant`, `key` is the Pusher key of the tenant, the key of
+        the current client if not given.
+        """
+        if self._auth_cache is not None:
+            self._auth_cache.delete(self._cache_key(user, key), channel)
+
     def channel_data(self, handler):
         self._channel_data_handler = handler
         return handler
@@ -127,18 +2160,40 @@ class Pusher(object):
 
         @bp.route(auth_path, methods=["POST"])
         def auth():
-            if not self._auth_handler:
-                abort(403)
+            return self.client.metrics.measure("auth", self._auth)
 
-            socket_id = request.form["socket_id"]
-            channel_name = request.form.get("channel_name")
-            if channel_name:
-                response = self._auth_simple(socket_id, channel_name)
-                if not response:
-                    abort(403)
-            else:
-                response = self._auth_buffered(socket_id)
-            return jsonify(response)
+        @bp.route("/chunked.js")
+        def chunked_js():
+            return current_app.response_class(
+                CHUNKED_EVENTS_JS, mimetype="application/javascript")
+
+        @bp.after_app_request
+        def response_status(response):
+            g._pusher_status = response.status_code
+            return response
+
+        @bp.teardown_app_request
+        def flush_outbox(exc):
+            collected = g.pop("_pusher_collected", None)
+            events = g.pop("_pusher_outbox", None)
+            status = g.pop("_pusher_status", None)
+            if exc is not None or (status is not None and status >= 400):
+                # the request failed, even if an error handler or `abort`
+                # gave the response. Contexts without a response (worker
+                # jobs, `test_request_context`) only fail with `exc`.
+                return
+            if collected:
+                try:
+                    self._flush_collected(list(collected.values()))
+                except Exception:
+                    logger.exception("Failed to send %d collected events",
+                                     len(collected))
+            if events:
+                try:
+                    self._flush_outbox(events)
+                except Exception:
+                    logger.exception("Failed to send %d outbox events",
+                                     len(events))
 
         @bp.app_context_processor
         def pusher_data():
@@ -147,42 +2202,172 @@ class Pusher(object):
             }
 
     def _sign(self, message):
-        return sign(self.client.secret, message)
+        return self.client.signer.sign(message)
 
     def _verify(self, message, signature):
         if not signature:
             return False
-        return verify(self.client.secret, message, signature)
+        return self.client.signer.verify(message, signature)
+
+    def _auth(self):
+        if not self._auth_handler and not self._auth_batch_handler:
+            abort(403)
+
+        socket_id = request.form["socket_id"]
+        channel_name = request.form.get("channel_name")
+        if channel_name:
+            channel_names = [channel_name]
+        else:
+            channel_names = self._buffered_channel_names()
+        self._validate_auth(socket_id, channel_names)
+
+        if channel_name:
+            response = self._auth_simple(socket_id, channel_name)
+            if not response:
+                abort(403)
+        else:
+            response = self._auth_buffered(socket_id, channel_names)
+        return jsonify(response)
+
+    def _validate_auth(self, socket_id, channel_names):
+        """Reject malformed and throttled auth requests."""
+        if not _SOCKET_ID_RE.match(socket_id):
+            abort(400)
+        for channel_name in channel_names:
+            if not _CHANNEL_RE.match(channel_name):
+                abort(400)
+            if not channel_name.startswith(_AUTH_PREFIXES):
+                # must never happen, this request is not from pusher
+                abort(404)
+
+        if self._auth_throttle is None:
+            return
+        key = None
+        if self._auth_throttle_key == "user":
+            key = self._user()
+        if key is None:
+            key = socket_id
+        wait = self._auth_throttle.acquire(key, len(channel_names))
+        if wait:
+            response = jsonify({"error": "Too many auth requests"})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(int(math.ceil(wait)))
+            abort(response)
 
     def _auth_simple(self, socket_id, channel_name):
-        if not self._auth_handler(channel_name, socket_id):
+        if not self._authorize(socket_id, [channel_name]):
             return None
         return self._auth_key(socket_id, channel_name)
 
-    def _auth_buffered(self, socket_id):
-        response = {}
+    def _buffered_channel_names(self):
+        channel_names = []
         while True:
-            n = len(response)
+            n = len(channel_names)
             channel_name = request.form.get("channel_name[%d]" % n)
             if not channel_name:
                 if n == 0:
                     # it is not a buffered request
                     abort(400)
                 break
-            r = {}
-            auth = self._auth_simple(socket_id, channel_name)
-            if auth:
-                r.update(status=200, data=auth)
+            if n >= self._auth_max_channels:
+                abort(400)
+            channel_names.append(channel_name)
+        return channel_names
+
+    def _auth_buffered(self, socket_id, channel_names):
+        authorized = self._authorize(socket_id, channel_names)
+        response = {}
+        for channel_name in channel_names:
+            if channel_name in authorized:
+                auth = self._auth_key(socket_id, channel_name)
+                response[channel_name] = {"status": 200, "data": auth}
             else:
-                r.update(status=403)
-            response[channel_name] = r
+                response[channel_name] = {"status": 403}
         return response
 
+    def _authorize(self, socket_id, channel_names):
+        """Return the set of authorized channels."""
+        authorized = set()
+        user = self._cache_user()
+        if user is not None:
+            pending = []
+            for channel_name in channel_names:
+                cached = self._auth_cache.get(user, channel_name)
+                if cached is None:
+                    pending.append(channel_name)
+                elif cached["authorized"]:
+                    authorized.add(channel_name)
+        else:
+            pending = channel_names
+
+        if not pending:
+            return authorized
+
+        allowed = self.client.metrics.measure(
+            "auth_handler", self._run_auth_handlers, socket_id, pending,
+            channels=len(channel_names))
+
+        if user is not None:
+            for channel_name in pending:
+                self._auth_cache.set(
+                    user, channel_name,
+                    {"authorized": channel_name in allowed},
+                    self._auth_cache_ttl)
+        return authorized | allowed
+
+    def _run_auth_handlers(self, socket_id, channel_names):
+        if self._auth_batch_handler:
+            pairs = [(channel_name, socket_id)
+                     for channel_name in channel_names]
+            result = _call(self._auth_batch_handler, pairs) or {}
+            return set(c for c in channel_names if result.get(c))
+        return set(c for c in channel_names
+                   if _call(self._auth_handler, c, socket_id))
+
+    def _cache_user(self):
+        if self._auth_cache is None:
+            return None
+        user = self._user()
+        if user is None:
+            return None
+        return self._cache_key(user)
+
+    def _cache_key(self, user, key=None):
+        # tenants can share user ids and channel names
+        if self._tenant_handler is None:
+            return user
+        if key is None:
+            key = self.client.key
+        return "%s:%s" % (key, user)
+
+    def _user(self):
+        if self._identity_handler is None:
+            return None
+        user = getattr(g, "_pusher_user", _missing)
+        if user is _missing:
+            user = g._pusher_user = _call(self._identity_handler)
+        return user
+
+    def _channel_data(self, socket_id, channel_name):
+        user = self._cache_user()
+        if user is not None:
+            cached = self._auth_cache.get(user, channel_name)
+            if cached is not None and "channel_data" in cached:
+                return cached["channel_data"]
+
+        data = _call(self._channel_data_handler, channel_name, socket_id)
+        if user is not None:
+            self._auth_cache.set(
+                user, channel_name,
+                {"authorized": True, "channel_data": data},
+                self._auth_cache_ttl)
+        return data
+
     def _auth_key(self, socket_id, channel_name):
         if channel_name.startswith("presence-"):
             channel_data = {"user_id": socket_id}
             if self._channel_data_handler:
-                d = self._channel_data_handler(channel_name, socket_id)
+                d = self._channel_data(socket_id, channel_name)
                 channel_data.update(d)
             auth_args = [socket_id, channel_data]
         elif channel_name.startswith("private-"):
@@ -191,7 +2376,21 @@ class Pusher(object):
             # must never happen, this request is not from pusher
             abort(404)
 
-        return self.client.authenticate(channel_name, *auth_args)
+        from flask_pusher_client import is_encrypted_channel
+        client = self.client
+        if not is_encrypted_channel(channel_name):
+            return client.signer.authenticate(channel_name, *auth_args)
+        if client.channel_keys is None:
+            response = client.authenticate(channel_name, *auth_args)
+            shared_secret = response["shared_secret"]
+            if isinstance(shared_secret, bytes):
+                # pusher returns bytes, not serializable to JSON
+                response["shared_secret"] = shared_secret.decode("ascii")
+            return response
+        response = client.signer.authenticate(channel_name, *auth_args)
+        response["shared_secret"] = client.channel_keys.secret(
+            channel_name, client._authentication_client._encryption_master_key)
+        return response
 
 
 class Webhooks(object):
@@ -202,9 +2401,48 @@ class Webhooks(object):
     def __init__(self, pusher):
         self.pusher = pusher
         self._handlers = {}
+        self._event_handlers = {}
+        self._executor = None
+        self._replay_guard = None
+        self._max_skew = None
+        self._stats_lock = threading.Lock()
+        self.stats = {"queued": 0, "processed": 0, "failed": 0,
+                      "rejected": 0, "duplicated": 0}
         self._register(self.CHANNEL_EXISTENCE_EVENT)
         self._register(self.PRESENCE_EVENT)
         self._register(self.CLIENT_EVENT)
+        self.pusher._blueprint.add_url_rule("/events", "events",
+                                            self._events_route,
+                                            methods=["POST"])
+
+    def init_app(self, app):
+        self._max_skew = app.config.get('PUSHER_WEBHOOKS_MAX_SKEW')
+        window = app.config.get('PUSHER_WEBHOOKS_DEDUPE_WINDOW')
+        if window:
+            self._replay_guard = _ReplayGuard(window)
+
+        if not app.config.get('PUSHER_WEBHOOKS_ASYNC'):
+            return
+        self._executor = app.config.get('PUSHER_WEBHOOKS_EXECUTOR')
+        if self._executor is None:
+            self._executor = _WorkerPool(
+                app.config.get('PUSHER_WEBHOOKS_WORKERS', 2),
+                app.config.get('PUSHER_WEBHOOKS_QUEUE_SIZE', 100),
+                name="flask-pusher-webhooks",
+            )
+
+    def on(self, event_name, prefix=None):
+        """
+        Handle an event (`channel_occupied`, `member_added`, `client_event`,
+        ...) of webhooks sent to the `/events` route. The handler receives
+        the event object. With `prefix`, only events of channels starting
+        with this prefix are handled.
+        """
+        def decorator(func):
+            handlers = self._event_handlers.setdefault(event_name, [])
+            handlers.append((prefix, func))
+            return func
+        return decorator
 
     def channel_existence(self, func):
         self._handlers[self.CHANNEL_EXISTENCE_EVENT] = func
@@ -223,22 +2461,141 @@ class Webhooks(object):
             func = self._handlers.get(event)
             if not func:
                 abort(404)
-            self._validate()
-            func()
-            return "OK", 200
+            if not self._validate():
+                return "OK", 200
+            self._apply(request.get_json(force=True, silent=True))
+            return self._process(_call, func)
 
         rule = "/events/%s" % event
         name = "%s_event" % event
         self.pusher._blueprint.add_url_rule(rule, name, route,
                                             methods=["POST"])
 
+    def _events_route(self):
+        if not self._event_handlers and not self.pusher.presence.enabled:
+            abort(404)
+        if not self._validate():
+            return "OK", 200
+        payload = request.get_json(force=True)
+        if not isinstance(payload, dict):
+            abort(400)
+        self._apply(payload)
+        return self._process(self._dispatch, payload)
+
+    def _process(self, func, *args):
+        """
+        Run the handlers inline or, in async mode, acknowledge the webhook
+        after handing the handlers to the executor.
+        """
+        if self._executor is None:
+            try:
+                func(*args)
+            except Exception:
+                # let the retry of this webhook be processed
+                self._forget()
+                raise
+            return "OK", 200
+
+        job = copy_current_request_context(self._run_job)
+        try:
+            self._executor.submit(job, g.get("_pusher_client"), func, *args)
+        except queue.Full:
+            self._forget()
+            self._count("rejected")
+            return "Service Unavailable", 503
+        self._count("queued")
+        return "OK", 200
+
+    def _run_job(self, client, func, *args):
+        if client is not None:
+            # the job runs in a new app context
+            g._pusher_client = client
+        try:
+            func(*args)
+        except Exception:
+            self._count("failed")
+            logger.exception("Webhook handler failed")
+        else:
+            self._count("processed")
+
+    def _forget(self):
+        """Forget the signature of this webhook, not processed."""
+        signature = g.pop("_pusher_webhook_signature", None)
+        if signature is not None:
+            self._replay_guard.forget(signature)
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _apply(self, payload):
+        if not isinstance(payload, dict):
+            return
+        presence = self.pusher.presence
+        if presence.enabled:
+            presence.apply(payload)
+        info_cache = self.pusher.client.info_cache
+        if info_cache is not None:
+            info_cache.apply(payload)
+
+    def _dispatch(self, payload):
+        for event in payload.get("events", ()):
+            handlers = self._event_handlers.get(event.get("name"), ())
+            channel = event.get("channel", "")
+            for prefix, func in handlers:
+                if prefix is None or channel.startswith(prefix):
+                    _call(func, event)
+
     def _validate(self):
         pusher_key = request.headers.get("X-Pusher-Key")
-        if pusher_key != self.pusher.client.key:
+        if pusher_key != self.pusher._webhook_client(pusher_key).key:
             # invalid pusher key
             abort(403)
 
         webhook_signature = request.headers.get("X-Pusher-Signature")
-        if not self.pusher._verify(request.data.decode(), webhook_signature):
+        start = _now()
+        valid = self.pusher._verify(request.data.decode(), webhook_signature)
+        metrics = self.pusher.client.metrics
+        if metrics.enabled("webhook_verify"):
+            metrics.record("webhook_verify", _now() - start,
+                           "ok" if valid else "invalid")
+        if not valid:
             # invalid signature
             abort(403)
+
+        if self._max_skew is not None:
+            payload = request.get_json(force=True, silent=True)
+            time_ms = None
+            if isinstance(payload, dict):
+                time_ms = payload.get("time_ms")
+            if not isinstance(time_ms, (int, float)) or \
+                    abs(time.time() * 1000 - time_ms) > self._max_skew * 1000:
+                # too old or from the future, probably a replay attack
+                abort(403)
+
+        if self._replay_guard is not None:
+            # the signature is an HMAC of the body, same for every retry
+            if self._replay_guard.seen(webhook_signature):
+                self._count("duplicated")
+                return False
+            g._pusher_webhook_signature = webhook_signature
+        return True
+
+
+# defined in `flask_pusher_client`, imported with `pusher` and `requests`
+# when the first client is built
+_client_names = ("CircuitOpen", "PooledBackend", "PusherRateLimited",
+                 "RateLimitExceeded")
+
+
+def __getattr__(name):
+    if name in _client_names:
+        import flask_pusher_client
+        return getattr(flask_pusher_client, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if sys.version_info < (3, 7):  # pragma: no cover
+    # no module `__getattr__`
+    from flask_pusher_client import (  # noqa
+        CircuitOpen, PooledBackend, PusherRateLimited, RateLimitExceeded)
@@ -0,0 +1,211 @@
+"""
+Asyncio support for Flask-Pusher. Requires Python 3.5+ and `aiohttp`.
+"""
+import asyncio
+import atexit
+import inspect
+
+import aiohttp
+from flask import current_app
+from pusher.http import process_response
+
+from flask_pusher import BroadcastResult, Presence, Pusher, _now, _Threads
+from flask_pusher_client import _Pusher
+
+
+class _Pending(object):
+    """Awaitable result of a request sent by the backend event loop."""
+    def __init__(self, future):
+        self._future = future
+
+    def __await__(self):
+        return asyncio.wrap_future(self._future).__await__()
+
+
+class AioHttpBackend(object):
+    """
+    `aiohttp` backend. Request methods of a client using this backend
+    return awaitables.
+
+    Requests are sent by an event loop of the backend, running in a daemon
+    thread, so its HTTP session and keep-alive connections are shared by
+    every view, even if each request runs in its own event loop. Requests
+    are sent even if their result is never awaited.
+
+    :param client: pusher.Client object
+    :param options: key-value passed to `aiohttp.ClientSession.request`
+    """
+    def __init__(self, client, **options):
+        self.client = client
+        self.options = options
+        self._loop = None
+        self._session = None
+        self._threads = _Threads([(self._run_loop, "flask-pusher-aiohttp")])
+
+    def _ensure_loop(self):
+        self._threads.start(setup=self._new_loop)
+        return self._loop
+
+    def _new_loop(self):
+        self._loop = asyncio.new_event_loop()
+        self._session = None
+        atexit.register(self.close)
+
+    def _run_loop(self):
+        self._loop.run_forever()
+
+    def send_request(self, request):
+        future = asyncio.run_coroutine_threadsafe(self._send(request),
+                                                  self._ensure_loop())
+        return _Pending(future)
+
+    async def _send(self, request):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        timeout = aiohttp.ClientTimeout(total=self.client.timeout)
+        response = await self._session.request(
+            request.method,
+            request.url,
+            data=request.body,
+            headers=request.headers,
+            timeout=timeout,
+            **self.options)
+        async with response:
+            body = await response.text("utf-8")
+        return process_response(response.status, body)
+
+    def close(self, timeout=None):
+        """Close the HTTP session and stop the event loop."""
+        loop = self._loop
+        threads = self._threads.stop()
+        if not threads:
+            return
+        if hasattr(atexit, "unregister"):
+            atexit.unregister(self.close)
+        asyncio.run_coroutine_threadsafe(
+            self._close_session(), loop).result(timeout)
+        loop.call_soon_threadsafe(loop.stop)
+        threads[0].join(timeout)
+        loop.close()
+
+    async def _close_session(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class _AsyncClient(_Pusher):
+    """Pusher client of `AsyncPusher`."""
+
+    def _last(self, responses):
+        # a call may send several requests, await all of them
+        return _await_last(responses)
+
+    def _measure(self, method, *args):
+        if not self.metrics.enabled("trigger"):
+            return method(*args)
+        labels = self._trigger_labels(method, args)
+        start = _now()
+        try:
+            pending = method(*args)
+        except Exception as e:
+            self.metrics.record("trigger", _now() - start, type(e).__name__,
+                                **labels)
+            raise
+        return self._measured(start, pending, labels)
+
+    async def _measured(self, start, pending, labels):
+        # the request is measured until its response, not when it is sent
+        outcome = "ok"
+        try:
+            return await pending
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            self.metrics.record("trigger", _now() - start, outcome, **labels)
+
+    async def broadcast(self, channels, event_name, data, socket_id=None,
+                        retries=1):
+        """
+        Trigger an event on any number of channels, split in chunks awaited
+        concurrently. Failed chunks are retried up to `retries` times.
+        """
+        chunks, data = self._broadcast_plan(channels, data)
+        result = BroadcastResult()
+
+        async def send(chunk):
+            return await _await_last([
+                self._trigger_now(chunk, event_name, data, socket_id)])
+
+        for attempt in range(retries + 1):
+            responses = await asyncio.gather(
+                *[send(chunk) for chunk in chunks], return_exceptions=True)
+            failed = []
+            for chunk, response in zip(chunks, responses):
+                if isinstance(response, Exception):
+                    failed.append((chunk, response))
+                else:
+                    result.succeeded.append(chunk)
+            if not failed:
+                break
+            chunks = [chunk for chunk, error in failed]
+        else:
+            result.failed = failed
+        return result
+
+
+async def _await_last(responses):
+    result = None
+    for response in responses:
+        result = await response if inspect.isawaitable(response) else response
+    return result
+
+
+class AsyncPresence(Presence):
+    """Presence state of `AsyncPusher`, with an awaitable `reconcile`."""
+
+    async def reconcile(self, client=None):
+        """Replace the state with the channels fetched from the REST API."""
+        if client is None:
+            client = current_app.extensions["pusher"]
+        channels = {}
+        response = await client.channels_info()
+        for channel in response.get("channels", {}):
+            members = None
+            if channel.startswith("presence-"):
+                users = (await client.users_info(channel)).get("users", ())
+                members = [user["id"] for user in users]
+            channels[channel] = members
+        self.storage.replace(channels)
+        self.synced = True
+
+
+class AsyncPusher(Pusher):
+    """
+    Pusher extension for async views. `trigger`, `trigger_batch`,
+    `channels_info`, `channel_info` and `users_info` return awaitables.
+
+    Features sending requests from sync code or several requests per
+    trigger are refused by `init_app`.
+    """
+    default_backend = AioHttpBackend
+    client_class = _AsyncClient
+    presence_class = AsyncPresence
+
+    SYNC_ONLY = ("PUSHER_QUEUE_SIZE", "PUSHER_OUTBOX", "PUSHER_COLLECT",
+                 "PUSHER_RATE_LIMIT", "PUSHER_CIRCUIT_BREAKER",
+                 "PUSHER_INFO_CACHE_TTL",
+                 "PUSHER_PRESENCE_RECONCILE_INTERVAL")
+
+    def init_app(self, app):
+        for key in self.SYNC_ONLY:
+            if app.config.get(key):
+                raise ValueError("%s is not supported by AsyncPusher" % key)
+        if app.config.get('PUSHER_OVERSIZE') == "split":
+            raise ValueError("PUSHER_OVERSIZE = 'split' is not supported "
+                             "by AsyncPusher")
+        super(AsyncPusher, self).init_app(app)
+
+    def outbox(self, channels, event_name, data, socket_id=None):
+        raise ValueError("outbox is not supported by AsyncPusher")
@@ -0,0 +1,467 @@
+"""
+Pusher client classes of Flask-Pusher.
+
+Importing this module imports `pusher` and `requests`, so `flask_pusher`
+only imports it when the first client is built.
+"""
+import atexit
+import os
+import random
+import threading
+import time
+
+import requests
+import pusher as _pusher
+from pusher.http import POST, Request, process_response
+from pusher import requests as pusher_requests
+from pusher.requests import RequestsBackend
+try:
+    from pusher.crypto import is_encrypted_channel
+except ImportError:  # pusher<2.1 has no encrypted channels
+    def is_encrypted_channel(channel):
+        return False
+from pusher.errors import PusherError, PusherBadStatus
+from pusher.util import ensure_text, validate_channel, validate_socket_id
+
+from flask_pusher import (BATCH_LIMIT, CHANNELS_LIMIT, BroadcastResult,
+                          _Metrics, _channel_list, _with_context,
+                          data_to_string)
+
+
+class PusherRateLimited(PusherBadStatus):
+    """The Pusher API refused a request with `429 Too Many Requests`."""
+    def __init__(self, message, retry_after=None):
+        super(PusherRateLimited, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimitExceeded(PusherError):
+    """The client rate limit did not allow a trigger in time."""
+
+
+class CircuitOpen(PusherError):
+    """The circuit breaker refused a request to the Pusher API."""
+
+
+class _Pusher(_pusher.Pusher):
+    """
+    Pusher client wrapper to get attributes from `_pusher_client`
+    if the attribute does not exist.
+
+    Provide backward compatibility to `pusher>=1.6`.
+    """
+    queue = None
+    spool = None
+    signer = None
+    occupancy = None
+    limiter = None
+    broadcast_pool = None
+    payload = None
+    info_cache = None
+    collector = None
+    breaker = None
+    fallback = None
+    channel_keys = None
+    metrics = _Metrics()
+
+    def __getattr__(self, attr):
+        client = self._pusher_client
+        return getattr(client, attr)
+
+    def trigger(self, channels, event_name, data, socket_id=None):
+        if self.collector is not None and self.collector.collect(
+                self, channels, event_name, data, socket_id):
+            return None
+        return self._trigger_now(channels, event_name, data, socket_id)
+
+    def _trigger_now(self, channels, event_name, data, socket_id,
+                     block=False):
+        """
+        `trigger` without collecting it. With `block`, wait for the rate
+        limit whatever its mode: the events of internal senders (queue,
+        spool, collector) are never dropped.
+        """
+        if self.occupancy is not None and self.occupancy.active:
+            channels = self.occupancy.filter(_channel_list(channels))
+            if not channels:
+                return self._last([{}])
+
+        if self.payload is None:
+            return self._trigger(channels, event_name, data, socket_id, block)
+
+        return self._last([
+            self._trigger(channels, event_name, data, socket_id, block)
+            for event_name, data in self.payload.prepare(event_name, data)
+        ])
+
+    def _trigger(self, channels, event_name, data, socket_id, block=False):
+        method = super(_Pusher, self).trigger
+        if self.channel_keys is not None:
+            channel_list = _channel_list(channels)
+            if (len(channel_list) == 1 and
+                    is_encrypted_channel(channel_list[0])):
+                method = self._trigger_encrypted
+
+        if self.limiter is None:
+            return self._send(method, channels, event_name, data, socket_id)
+
+        channel_list = _channel_list(channels)
+        if not self.limiter.acquire(channel_list,
+                                    can_defer=self.queue is not None,
+                                    block=block):
+            if self.limiter.mode == "defer" and self.queue is not None:
+                return self.enqueue(channel_list, event_name, data,
+                                    socket_id)
+            return None
+        return self.limiter.send(
+            self._send, method, channels, event_name, data, socket_id)
+
+    def _trigger_encrypted(self, channels, event_name, data, socket_id=None):
+        """
+        `trigger` to a single encrypted channel, encrypting `data` with the
+        cached channel key.
+        """
+        client = self._pusher_client
+        channel = validate_channel(_channel_list(channels)[0])
+        event_name = ensure_text(event_name, "event_name")
+        if len(event_name) > 200:
+            raise ValueError("event_name too long")
+        data = data_to_string(data, client._json_encoder)
+        if len(data) > 10240:
+            raise ValueError("Too much data")
+
+        params = {
+            "name": event_name,
+            "channels": [channel],
+            "data": self.channel_keys.encrypt(
+                channel, data, client._encryption_master_key),
+        }
+        if socket_id:
+            params["socket_id"] = validate_socket_id(socket_id)
+        return client.http.send_request(
+            Request(client, POST, "/apps/%s/events" % client.app_id, params))
+
+    def _encrypt_batch(self, batch):
+        """
+        Validate and encode a batch like `trigger_batch`, encrypting the
+        events of encrypted channels with the cached channel keys.
+        """
+        client = self._pusher_client
+        events = []
+        for event in batch:
+            channel = validate_channel(event["channel"])
+            if len(ensure_text(event["name"], "event_name")) > 200:
+                raise ValueError("event_name too long")
+            data = data_to_string(event["data"], client._json_encoder)
+            if len(data) > 10240:
+                raise ValueError("Too much data")
+            if is_encrypted_channel(channel):
+                data = self.channel_keys.encrypt(
+                    channel, data, client._encryption_master_key)
+            events.append(dict(event, data=data))
+        return events
+
+    def trigger_batch(self, batch=[], already_encoded=False):
+        return self._trigger_batch_now(batch, already_encoded)
+
+    def _trigger_batch_now(self, batch, already_encoded=False, block=False):
+        """`trigger_batch`, waiting for the rate limit with `block`."""
+        if self.occupancy is not None and self.occupancy.active:
+            occupied = set(self.occupancy.filter(
+                [event["channel"] for event in batch]))
+            batch = [event for event in batch
+                     if event["channel"] in occupied]
+            if not batch:
+                return self._last([{}])
+
+        if self.payload is None or already_encoded:
+            return self._trigger_batch(batch, already_encoded, block)
+
+        events = []
+        for event in batch:
+            for event_name, data in self.payload.prepare(event["name"],
+                                                         event["data"]):
+                events.append(dict(event, name=event_name, data=data))
+
+        return self._last([
+            self._trigger_batch(events[i:i + BATCH_LIMIT], False, block)
+            for i in range(0, len(events), BATCH_LIMIT)
+        ])
+
+    def _last(self, responses):
+        """Return the response of the last request sent by a call."""
+        return responses[-1] if responses else None
+
+    def _trigger_batch(self, batch, already_encoded, block=False):
+        if (self.channel_keys is not None and not already_encoded and
+                any(is_encrypted_channel(event["channel"])
+                    for event in batch)):
+            batch = self._encrypt_batch(batch)
+            already_encoded = True
+
+        if self.limiter is None:
+            return self._send(super(_Pusher, self).trigger_batch,
+                              batch, already_encoded)
+
+        if not self.limiter.acquire([event["channel"] for event in batch],
+                                    block=block):
+            return None
+        return self.limiter.send(
+            self._send, super(_Pusher, self).trigger_batch,
+            batch, already_encoded)
+
+    def channels_info(self, prefix_filter=None, attributes=[],
+                      cache_ttl=None):
+        if self.info_cache is None:
+            return self._pusher_client.channels_info(prefix_filter,
+                                                     attributes)
+        return self.info_cache.get(
+            ("channels_info", prefix_filter, tuple(attributes)),
+            lambda: self._pusher_client.channels_info(prefix_filter,
+                                                      attributes),
+            cache_ttl)
+
+    def channel_info(self, channel, attributes=[], cache_ttl=None):
+        if self.info_cache is None:
+            return self._pusher_client.channel_info(channel, attributes)
+        return self.info_cache.get(
+            ("channel_info", channel, tuple(attributes)),
+            lambda: self._pusher_client.channel_info(channel, attributes),
+            cache_ttl)
+
+    def users_info(self, channel, cache_ttl=None):
+        if self.info_cache is None:
+            return self._pusher_client.users_info(channel)
+        return self.info_cache.get(
+            ("users_info", channel),
+            lambda: self._pusher_client.users_info(channel),
+            cache_ttl)
+
+    def _send(self, method, *args):
+        try:
+            return self._measure(method, *args)
+        except CircuitOpen as e:
+            if self.fallback is None:
+                raise
+            if method.__name__ != "trigger_batch":
+                channels, event_name, data, socket_id = args
+                events = []
+                for channel in _channel_list(channels):
+                    event = {"channel": channel, "name": event_name,
+                             "data": data}
+                    if socket_id:
+                        event["socket_id"] = socket_id
+                    events.append(event)
+            else:
+                events = args[0]
+            return self.fallback(events, e)
+
+    def _measure(self, method, *args):
+        if not self.metrics.enabled("trigger"):
+            return method(*args)
+        return self.metrics.measure("trigger", method, *args,
+                                    **self._trigger_labels(method, args))
+
+    @staticmethod
+    def _trigger_labels(method, args):
+        if method.__name__ == "trigger_batch":
+            return {"method": "trigger_batch", "channels": len(args[0])}
+        return {"method": "trigger", "channels": len(_channel_list(args[0]))}
+
+    def broadcast(self, channels, event_name, data, socket_id=None,
+                  retries=1):
+        """
+        Trigger an event on any number of channels, split in chunks sent
+        concurrently. Failed chunks are retried up to `retries` times.
+        """
+        chunks, data = self._broadcast_plan(channels, data)
+        result = BroadcastResult()
+        for attempt in range(retries + 1):
+            failed = self._broadcast_chunks(chunks, event_name, data,
+                                            socket_id, result)
+            if not failed:
+                break
+            chunks = [chunk for chunk, error in failed]
+        else:
+            result.failed = failed
+        return result
+
+    def _broadcast_plan(self, channels, data):
+        """Encode `data` once and split `channels` in trigger chunks."""
+        if self.payload is not None:
+            data = self.payload.encode(data)
+        else:
+            data = data_to_string(data, self._json_encoder)
+        chunks = []
+        plain = []
+        for channel in _channel_list(channels):
+            if is_encrypted_channel(channel):
+                # encrypted channels can't share a trigger
+                chunks.append([channel])
+            else:
+                plain.append(channel)
+        chunks.extend(plain[i:i + CHANNELS_LIMIT]
+                      for i in range(0, len(plain), CHANNELS_LIMIT))
+        return chunks, data
+
+    def _broadcast_chunks(self, chunks, event_name, data, socket_id, result):
+        failed = []
+        lock = threading.Lock()
+        done = threading.Semaphore(0)
+
+        # fallback handlers and signals of the workers need the app context
+        @_with_context
+        def send(chunk):
+            try:
+                self._trigger_now(chunk, event_name, data, socket_id)
+            except Exception as e:
+                with lock:
+                    failed.append((chunk, e))
+            else:
+                with lock:
+                    result.succeeded.append(chunk)
+            finally:
+                done.release()
+
+        for chunk in chunks:
+            if self.broadcast_pool is None:
+                send(chunk)
+            else:
+                self.broadcast_pool.submit(send, chunk)
+        for _ in chunks:
+            done.acquire()
+        return failed
+
+    def enqueue(self, channels, event_name, data, socket_id=None):
+        """
+        Defer a trigger to the background queue, falling back to a
+        blocking `trigger` if the queue is not enabled.
+        """
+        if self.queue is None:
+            return self.trigger(channels, event_name, data, socket_id)
+
+        # errors are raised here, not in the worker sending a whole batch
+        for event in self._encode_events(channels, event_name, data,
+                                         socket_id):
+            self.queue.put(event)
+
+    def _encode_events(self, channels, event_name, data, socket_id=None):
+        """
+        Validate and encode the `trigger_batch` events of a deferred
+        trigger, raising errors before the events are stored.
+        """
+        if self.payload is not None:
+            prepared = self.payload.prepare(event_name, data)
+        else:
+            prepared = [(event_name,
+                         data_to_string(data, self._json_encoder))]
+        for event_name, data in prepared:
+            if len(ensure_text(event_name, "event_name")) > 200:
+                raise ValueError("event_name too long")
+            if len(data) > 10240:
+                raise ValueError("Too much data")
+        channels = [validate_channel(c) for c in _channel_list(channels)]
+        if socket_id:
+            socket_id = validate_socket_id(socket_id)
+
+        events = []
+        for channel in channels:
+            for event_name, data in prepared:
+                event = {"channel": channel, "name": event_name,
+                         "data": data}
+                if socket_id:
+                    event["socket_id"] = socket_id
+                events.append(event)
+        return events
+
+    def close(self):
+        """Drain the queue, stop the workers and close the connections."""
+        for worker in (self.queue, self.spool, self.broadcast_pool):
+            if worker is not None:
+                worker.close()
+                if hasattr(atexit, "unregister"):  # Python 3
+                    atexit.unregister(worker.close)
+        backends = []
+        for client in (self._pusher_client, self._authentication_client,
+                       self._notification_client):
+            if client.http not in backends:
+                backends.append(client.http)
+        for backend in backends:
+            close = getattr(backend, "close", None)
+            if close is not None:
+                close()
+
+
+class PooledBackend(RequestsBackend):
+    """
+    `requests` backend with a per-process keep-alive connection pool.
+
+    Requests failing with a connection error, usually a pooled connection
+    closed by the server while idle, are retried up to `retries` times after
+    a random backoff. The pool is recreated in a forked process.
+    """
+    def __init__(self, client, pool_connections=10, pool_maxsize=10,
+                 retries=1, backoff=0.05, **options):
+        self.client = client
+        self.options = options
+        if self.client.ssl:
+            self.options.update({'verify': pusher_requests.CERT_PATH})
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.retries = retries
+        self.backoff = backoff
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = self._make_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def close(self):
+        """Close the pooled connections, a new pool is made on next use."""
+        with self._lock:
+            session, self._session = self._session, None
+            self._pid = None
+        if session is not None:
+            session.close()
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def send_request(self, request):
+        attempt = 0
+        while True:
+            try:
+                resp = self.session.request(
+                    request.method,
+                    request.url,
+                    headers=request.headers,
+                    data=request.body,
+                    timeout=self.client.timeout,
+                    **self.options)
+            except requests.exceptions.ConnectionError:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                # full jitter, avoid retrying all workers at the same time
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            else:
+                if resp.status_code == 429:
+                    retry_after = resp.headers.get("Retry-After")
+                    raise PusherRateLimited(
+                        "%s: %s" % (resp.status_code, resp.text),
+                        float(retry_after) if retry_after else None)
+                return process_response(resp.status_code, resp.text)
@@ -1,8 +1,15 @@
+import sys
+
 from setuptools import setup
 
 with open('README.md') as fh:
     long_description = fh.read()
 
+py_modules = ['flask_pusher', 'flask_pusher_client']
+# `async def` is a syntax error before Python 3.5
+if sys.version_info >= (3, 5):
+    py_modules.append('flask_pusher_async')
+
 setup(
     name='Flask-Pusher',
     version='3.0',
@@ -13,7 +20,7 @@ setup(
     description='Flask extension for Pusher',
     long_description=long_description,
     long_description_content_type='text/markdown',
-    py_modules=['flask_pusher'],
+    py_modules=py_modules,
     zip_safe=False,
     include_package_data=True,
     platforms='any',
@@ -22,6 +29,12 @@ setup(
         'pusher<3',
         'Flask-Jsonpify',  # for jsonp auth support
     ],
+    extras_require={
+        'async': [
+            'Flask[async]>=2.0; python_version >= "3.6"',
+            'aiohttp>=3.3; python_version >= "3.5"',
+        ],
+    },
     test_suite="tests",
     tests_require=[
         'mock<=3.0.5',
@@ -1,13 +1,42 @@
+import base64
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 try:
     from unittest import mock
 except ImportError:
     import mock
 from decimal import Decimal
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import pusher as _pusher
-from flask import Flask, json, render_template_string, url_for
-from flask_pusher import Pusher
+from flask import (Flask, abort, current_app, g, json,
+                   render_template_string, request, url_for)
+import requests
+try:
+    import nacl.secret
+    from pusher.crypto import generate_shared_secret
+except ImportError:  # pusher<2.1
+    generate_shared_secret = None
+from pusher.signature import sign
+from pusher.util import data_to_string
+from pusher.errors import PusherBadRequest, PusherBadStatus
+from flask_pusher import (CircuitOpen, MetricsRegistry, Pusher,
+                          PayloadTooLarge, PooledBackend, PusherRateLimited,
+                          RateLimitExceeded, RedisAuthCache,
+                          RedisPresenceStorage, RequestMetrics, Signer,
+                          trigger_sent, _metric_signals, _now,
+                          _PayloadEncoder)
+import benchmarks
 
 pusher_conf = {
     "PUSHER_APP_ID": "1234",
@@ -105,6 +134,38 @@ class PusherClientTest(unittest.TestCase):
             rendered = render_template_string("{{ PUSHER_KEY }}")
             self.assertEqual("KEY", rendered)
 
+    def test_lazy_client(self):
+        backend = mock.Mock()
+        self.app.config.update({
+            "PUSHER_LAZY": True,
+            "PUSHER_BACKEND": backend,
+        })
+        pusher = Pusher(self.app)
+        self.assertFalse(backend.called)
+        with self.app.test_request_context():
+            client = pusher.client
+            self.assertEqual("KEY", client.key)
+            self.assertTrue(backend.called)
+            self.assertIs(client, self.app.extensions["pusher"])
+            self.assertIs(client, pusher.client)
+        self.assertEqual(3, backend.call_count)
+
+    def test_lazy_client_from_extensions_map(self):
+        self.app.config["PUSHER_LAZY"] = True
+        Pusher(self.app)
+        client = self.app.extensions["pusher"]
+        self.assertEqual("KEY", client.key)
+        self.assertIsNot(client, self.app.extensions["pusher"])
+        self.assertEqual("KEY", self.app.extensions["pusher"].key)
+
+    def test_import_is_light(self):
+        code = ("import sys, flask_pusher; "
+                "print(sorted(m for m in ('pusher', 'requests', "
+                "'flask_jsonpify', 'flask_pusher_client') "
+                "if m in sys.modules))")
+        output = subprocess.check_output([sys.executable, "-c", code])
+        self.assertEqual("[]", output.decode().strip())
+
 
 class PusherAuthTest(unittest.TestCase):
 
@@ -233,6 +294,40 @@ class PusherBatchAuthTest(unittest.TestCase):
         self.assertIn("auth", c_data)
         self.assertIn("channel_data", c_data)
 
+    def test_auth_batch(self):
+        calls = []
+
+        @self.pusher.auth_batch
+        def auth_batch(pairs):
+            calls.append(pairs)
+            return dict((c, "b" not in c) for c, s in pairs)
+
+        response = self.client.post("/pusher/auth",
+                                    data={"channel_name[0]": "private-a",
+                                          "channel_name[1]": "private-b",
+                                          "channel_name[2]": "presence-c",
+                                          "socket_id": SOCKET_ID})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([[("private-a", SOCKET_ID),
+                           ("private-b", SOCKET_ID),
+                           ("presence-c", SOCKET_ID)]], calls)
+        data = json.loads(response.data)
+        self.assertEqual(200, data["private-a"]["status"])
+        self.assertIn("auth", data["private-a"]["data"])
+        self.assertEqual(403, data["private-b"]["status"])
+        self.assertIn("channel_data", data["presence-c"]["data"])
+
+    def test_auth_batch_simple_request(self):
+        self.pusher.auth_batch(lambda pairs: {"private-b": True})
+        response = self.client.post("/pusher/auth",
+                                    data={"channel_name": "private-a",
+                                          "socket_id": SOCKET_ID})
+        self.assertEqual(403, response.status_code)
+        response = self.client.post("/pusher/auth",
+                                    data={"channel_name": "private-b",
+                                          "socket_id": SOCKET_ID})
+        self.assertEqual(200, response.status_code)
+
     def test_missing_channel(self):
         self.pusher.auth(lambda c, s: True)
         response = self.client.post("/pusher/auth",
@@ -241,6 +336,497 @@ class PusherBatchAuthTest(unittest.TestCase):
         self.assertEqual(400, response.status_code)
 
 
+class PusherAuthValidationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config.update({
+            "PUSHER_AUTH_MAX_CHANNELS": 3,
+            "PUSHER_AUTH_RATE_LIMIT": 1,
+            "PUSHER_AUTH_RATE_LIMIT_BURST": 4,
+        })
+        self.pusher = Pusher(self.app)
+        self.handler = mock.Mock(return_value=True)
+        self.pusher.auth(self.handler)
+        self.client = self.app.test_client()
+        self.clock = FakeClock()
+        patcher = mock.patch("flask_pusher._now", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _auth(self, channels, socket_id=SOCKET_ID):
+        data = dict(("channel_name[%d]" % i, c)
+                    for i, c in enumerate(channels))
+        data["socket_id"] = socket_id
+        return self.client.post("/pusher/auth", data=data)
+
+    def test_invalid_socket_id(self):
+        for socket_id in ["", "1234", "a.b", "1.2.3", "1.2\n"]:
+            response = self._auth(["private-a"], socket_id)
+            self.assertEqual(400, response.status_code)
+        self.assertFalse(self.handler.called)
+
+    def test_invalid_channel(self):
+        for channel in ["private-a b", "private-" + "a" * 200]:
+            response = self.client.post("/pusher/auth", data={
+                "channel_name": channel, "socket_id": SOCKET_ID})
+            self.assertEqual(400, response.status_code)
+            self.assertEqual(400, self._auth([channel]).status_code)
+        self.assertFalse(self.handler.called)
+
+    def test_unknown_prefix(self):
+        response = self._auth(["private-a", "public-b"])
+        self.assertEqual(404, response.status_code)
+        self.assertFalse(self.handler.called)
+
+    def test_max_channels(self):
+        response = self._auth(["private-a", "private-b", "private-c"])
+        self.assertEqual(200, response.status_code)
+        response = self._auth(["private-%d" % i for i in range(4)])
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(3, self.handler.call_count)
+
+    def test_throttle_socket_id(self):
+        self.assertEqual(200, self._auth(["private-a"] * 3).status_code)
+        self.assertEqual(200, self._auth(["private-a"]).status_code)
+        response = self._auth(["private-a"])
+        self.assertEqual(429, response.status_code)
+        self.assertEqual("1", response.headers["Retry-After"])
+        # other clients have their own budget
+        self.assertEqual(200, self._auth(["private-a"], "1.2").status_code)
+        self.clock.now += 1
+        self.assertEqual(200, self._auth(["private-a"]).status_code)
+        self.assertEqual(1, self.pusher._auth_throttle.throttled)
+
+    def test_throttle_user(self):
+        app = Flask(__name__)
+        app.config.update(self.app.config)
+        app.config["PUSHER_AUTH_RATE_LIMIT_KEY"] = "user"
+        pusher = Pusher(app)
+        pusher.auth(self.handler)
+        pusher.identity(lambda: request.form.get("user"))
+        client = app.test_client()
+
+        def auth(socket_id, user=None):
+            data = {"channel_name": "private-a", "socket_id": socket_id}
+            if user:
+                data["user"] = user
+            return client.post("/pusher/auth", data=data).status_code
+
+        for i in range(4):
+            self.assertEqual(200, auth("1.%d" % i, "foo"))
+        self.assertEqual(429, auth("1.9", "foo"))
+        self.assertEqual(200, auth("1.9", "bar"))
+        # without user, the socket_id is the key
+        self.assertEqual(200, auth("1.9"))
+
+    def test_invalid_throttle_key(self):
+        app = Flask(__name__)
+        app.config.update(self.app.config)
+        app.config["PUSHER_AUTH_RATE_LIMIT_KEY"] = "ip"
+        self.assertRaises(ValueError, Pusher, app)
+
+
+class PusherPooledBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+
+    def _backend(self):
+        self.pusher = Pusher(self.app)
+        with self.app.test_request_context():
+            return self.pusher.client.http
+
+    def test_default_backend(self):
+        self.app.config.update({
+            "PUSHER_POOL_SIZE": 2,
+            "PUSHER_POOL_MAXSIZE": 20,
+            "PUSHER_POOL_RETRIES": 3,
+        })
+        backend = self._backend()
+        self.assertIsInstance(backend, PooledBackend)
+        self.assertEqual(3, backend.retries)
+        adapter = backend.session.get_adapter("https://api.pusherapp.com")
+        self.assertEqual(2, adapter._pool_connections)
+        self.assertEqual(20, adapter._pool_maxsize)
+
+    def test_retry_connection_error(self):
+        backend = self._backend()
+        backend.backoff = 0
+        response = mock.Mock(status_code=200, text="{}")
+        with mock.patch.object(backend.session, "request", side_effect=[
+                requests.exceptions.ConnectionError(), response]) as req:
+            with self.app.test_request_context():
+                self.assertEqual({}, self.pusher.client.trigger(
+                    "a", "ev", "x"))
+        self.assertEqual(2, req.call_count)
+
+    def test_retries_exhausted(self):
+        backend = self._backend()
+        backend.backoff = 0
+        error = requests.exceptions.ConnectionError()
+        with mock.patch.object(backend.session, "request",
+                               side_effect=error) as req:
+            with self.app.test_request_context():
+                self.assertRaises(requests.exceptions.ConnectionError,
+                                  self.pusher.client.trigger,
+                                  "a", "ev", "x")
+        self.assertEqual(2, req.call_count)
+
+    def test_new_pool_after_fork(self):
+        backend = self._backend()
+        session = backend.session
+        self.assertIs(session, backend.session)
+        with mock.patch("os.getpid", return_value=-1):
+            self.assertIsNot(session, backend.session)
+
+    def test_close(self):
+        backend = self._backend()
+        session = backend.session
+        with mock.patch.object(session, "close") as close:
+            backend.close()
+        self.assertTrue(close.called)
+        self.assertIsNot(session, backend.session)
+
+
+class PusherQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config["PUSHER_QUEUE_SIZE"] = 100
+        self.app.config["PUSHER_QUEUE_FLUSH_INTERVAL"] = 0.05
+
+    def test_disabled_triggers_immediately(self):
+        del self.app.config["PUSHER_QUEUE_SIZE"]
+        pusher = Pusher(self.app)
+        with self.app.test_request_context():
+            with mock.patch.object(pusher.client, "trigger") as trigger:
+                pusher.enqueue("a", "ev", {"x": 1})
+        trigger.assert_called_once_with("a", "ev", {"x": 1}, None)
+
+    def test_coalesce_events(self):
+        pusher = Pusher(self.app)
+        with self.app.test_request_context():
+            client = pusher.client
+        with mock.patch.object(client, "_trigger_batch_now") as trigger_batch:
+            with self.app.test_request_context():
+                pusher.enqueue(["a", "b"], "ev", {"x": 1})
+                pusher.enqueue("c", "ev", {"x": 2}, socket_id=SOCKET_ID)
+            client.queue.join()
+        trigger_batch.assert_called_once_with([
+            {"channel": "a", "name": "ev", "data": '{"x": 1}'},
+            {"channel": "b", "name": "ev", "data": '{"x": 1}'},
+            {"channel": "c", "name": "ev", "data": '{"x": 2}',
+             "socket_id": SOCKET_ID},
+        ], block=True)
+
+    def test_invalid_events_raise(self):
+        pusher = Pusher(self.app)
+        with self.app.test_request_context():
+            client = pusher.client
+        with mock.patch.object(client._pusher_client.http, "send_request",
+                               return_value={}) as send_request:
+            with self.app.test_request_context():
+                for i in range(5):
+                    pusher.enqueue("a", "ev", {"i": i})
+                self.assertRaises(PayloadTooLarge, pusher.enqueue,
+                                  "a", "ev", "x" * 20480)
+                self.assertRaises(ValueError, pusher.enqueue,
+                                  "bad channel!", "ev", "x")
+            client.queue.join()
+        batch = send_request.call_args[0][0].params["batch"]
+        self.assertEqual(1, send_request.call_count)
+        self.assertEqual(5, len(batch))
+
+    def test_batch_limit(self):
+        pusher = Pusher(self.app)
+        with self.app.test_request_context():
+            client = pusher.client
+        with mock.patch.object(client, "_trigger_batch_now") as trigger_batch:
+            with self.app.test_request_context():
+                pusher.enqueue(["c%d" % i for i in range(25)], "ev", "x")
+            client.queue.join()
+        sizes = [len(c[0][0]) for c in trigger_batch.call_args_list]
+        self.assertEqual([10, 10, 5], sizes)
+
+    def test_backpressure(self):
+        self.app.config["PUSHER_QUEUE_SIZE"] = 1
+        self.app.config["PUSHER_QUEUE_BATCH_SIZE"] = 1
+        self.app.config["PUSHER_QUEUE_TIMEOUT"] = 0.01
+        pusher = Pusher(self.app)
+        with self.app.test_request_context():
+            client = pusher.client
+        release = threading.Event()
+        with mock.patch.object(client, "_trigger_batch_now",
+                               side_effect=lambda b, block: release.wait()):
+            with self.app.test_request_context():
+                self.assertRaises(queue.Full, pusher.enqueue,
+                                  ["a", "b", "c"], "ev", "x")
+            release.set()
+            client.queue.close()
+
+    def test_new_worker_after_fork(self):
+        pusher = Pusher(self.app)
+        with self.app.test_request_context():
+            client = pusher.client
+
+        def workers():
+            return [t for t in threading.enumerate()
+                    if t.name == "flask-pusher-queue"]
+
+        with mock.patch.object(client, "_trigger_batch_now") as trigger_batch:
+            with self.app.test_request_context():
+                pusher.enqueue("a", "ev", "x")
+                client.queue.join()
+                before = workers()
+                with mock.patch("os.getpid", return_value=-1):
+                    pusher.enqueue("b", "ev", "x")
+                    client.queue.join()
+                self.assertEqual(len(before) + 1, len(workers()))
+        self.assertEqual(2, trigger_batch.call_count)
+
+    def test_restart_after_close(self):
+        pusher = Pusher(self.app)
+        with self.app.test_request_context():
+            client = pusher.client
+        with mock.patch.object(client, "_trigger_batch_now") as trigger_batch:
+            with self.app.test_request_context():
+                pusher.enqueue("a", "ev", "x")
+                client.queue.close()
+                pusher.enqueue("b", "ev", "x")
+                client.queue.join()
+        self.assertEqual(2, trigger_batch.call_count)
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.data = {}
+        self.ttl = {}
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value.encode("utf-8")
+
+    def hdel(self, key, field):
+        self.data.get(key, {}).pop(field, None)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def expire(self, key, ttl):
+        self.ttl[key] = ttl
+
+    def sadd(self, key, *values):
+        self.data.setdefault(key, set()).update(
+            v.encode("utf-8") for v in values)
+
+    def srem(self, key, value):
+        self.data.get(key, set()).discard(value.encode("utf-8"))
+
+    def smembers(self, key):
+        return set(self.data.get(key, ()))
+
+    def sismember(self, key, value):
+        return value.encode("utf-8") in self.data.get(key, ())
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    """Commands queued and applied at once by `execute`, like MULTI."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue_command(*args):
+            self.commands.append((name, args))
+        return queue_command
+
+    def execute(self):
+        for name, args in self.commands:
+            getattr(self.redis, name)(*args)
+
+
+class PusherAuthCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.debug = True
+        self.app.config.update(pusher_conf)
+        self.app.config["PUSHER_AUTH_CACHE_TTL"] = 60
+        self.calls = []
+        self.user = "u1"
+
+    def _init(self):
+        self.pusher = Pusher(self.app)
+        self.client = self.app.test_client()
+
+        @self.pusher.identity
+        def identity():
+            return self.user
+
+        @self.pusher.auth
+        def auth(channel_name, socket_id):
+            self.calls.append(("auth", channel_name))
+            return "b" not in channel_name
+
+        @self.pusher.channel_data
+        def channel_data(channel_name, socket_id):
+            self.calls.append(("channel_data", channel_name))
+            return {"name": "Foo"}
+
+    def _auth(self, channel_name, socket_id=SOCKET_ID):
+        return self.client.post("/pusher/auth",
+                                data={"channel_name": channel_name,
+                                      "socket_id": socket_id})
+
+    def test_cached_decision(self):
+        self._init()
+        self.assertEqual(200, self._auth("private-a").status_code)
+        self.assertEqual(200, self._auth("private-a").status_code)
+        self.assertEqual(403, self._auth("private-b").status_code)
+        self.assertEqual(403, self._auth("private-b").status_code)
+        self.assertEqual([("auth", "private-a"), ("auth", "private-b")],
+                         self.calls)
+
+    def test_cached_channel_data_signed_per_socket(self):
+        self._init()
+        r1 = json.loads(self._auth("presence-a", "1.1").data)
+        r2 = json.loads(self._auth("presence-a", "2.2").data)
+        self.assertEqual([("auth", "presence-a"),
+                          ("channel_data", "presence-a")], self.calls)
+        self.assertEqual({"user_id": "2.2", "name": "Foo"},
+                         json.loads(r2["channel_data"]))
+        self.assertNotEqual(r1["auth"], r2["auth"])
+
+    def test_per_user(self):
+        self._init()
+        self._auth("private-a")
+        self.user = "u2"
+        self._auth("private-a")
+        self.user = None
+        self._auth("private-a")
+        self.assertEqual(3, len(self.calls))
+
+    def test_invalidate(self):
+        self._init()
+        self._auth("private-a")
+        self._auth("private-c")
+        self.pusher.invalidate("u1", "private-a")
+        self._auth("private-a")
+        self._auth("private-c")
+        self.assertEqual(3, len(self.calls))
+        self.pusher.invalidate("u1")
+        self._auth("private-a")
+        self._auth("private-c")
+        self.assertEqual(5, len(self.calls))
+
+    def test_expired(self):
+        self._init()
+        self._auth("private-a")
+        with mock.patch("flask_pusher._now", return_value=time.time() + 1e9):
+            self._auth("private-a")
+        self.assertEqual(2, len(self.calls))
+
+    def test_lru_bound(self):
+        self.app.config["PUSHER_AUTH_CACHE_SIZE"] = 2
+        self._init()
+        for channel_name in ("private-a", "private-c", "private-d",
+                             "private-a"):
+            self._auth(channel_name)
+        self.assertEqual(4, len(self.calls))
+
+    def test_redis_store(self):
+        redis = FakeRedis()
+        self.app.config["PUSHER_AUTH_CACHE_STORE"] = RedisAuthCache(redis)
+        self._init()
+        self._auth("presence-a")
+        self._auth("presence-a")
+        self.assertEqual(2, len(self.calls))
+        self.assertIn("presence-a", redis.data["flask-pusher:auth:u1"])
+        self.pusher.invalidate("u1")
+        self.assertEqual({}, redis.data)
+
+
+class CompactJSONEncoder(CustomJSONEncoder):
+    def __init__(self, *args, **kwargs):
+        kwargs.update(separators=(",", ":"), sort_keys=True)
+        super(CompactJSONEncoder, self).__init__(*args, **kwargs)
+
+
+class SignerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.signer = Signer("KEY", "SUPERSECRET", CustomJSONEncoder)
+        self.upstream = _pusher.Pusher("1234", "KEY", "SUPERSECRET",
+                                       json_encoder=CompactJSONEncoder)
+
+    def assertSameAuth(self, channel, socket_id, custom_data=None):
+        self.assertEqual(
+            self.upstream.authenticate(channel, socket_id, custom_data),
+            self.signer.authenticate(channel, socket_id, custom_data))
+
+    def test_private_channel(self):
+        self.assertSameAuth("private-a", SOCKET_ID)
+        self.assertSameAuth("private-a;b@c=d", "123456.7890")
+
+    def test_presence_channel(self):
+        self.assertSameAuth("presence-a", SOCKET_ID, {"user_id": SOCKET_ID})
+        self.assertSameAuth("presence-a", SOCKET_ID, {
+            "user_id": 42,
+            "user_info": {"name": u"Jos\xe9", "tags": ["a", "b"],
+                          "z": None, "a": 1.5},
+        })
+
+    def test_custom_encoder(self):
+        self.assertSameAuth("presence-a", SOCKET_ID,
+                            {"user_id": "1", "price": Decimal("1.10")})
+
+    def test_empty_custom_data(self):
+        self.assertSameAuth("presence-a", SOCKET_ID, {})
+
+    def test_invalid_arguments(self):
+        for args in (("private a", SOCKET_ID), ("private-a", "42")):
+            self.assertRaises(ValueError, self.upstream.authenticate, *args)
+            self.assertRaises(ValueError, self.signer.authenticate, *args)
+        # checked like upstream, even if `validate_channel` does not
+        with mock.patch("pusher.util.validate_channel", lambda c: c):
+            self.assertRaises(ValueError, self.signer.authenticate,
+                              "private a", SOCKET_ID)
+
+    def test_channel_data_format(self):
+        # the upstream client of an app, with its own encoder
+        upstream = _pusher.Pusher("1234", "KEY", "SUPERSECRET",
+                                  json_encoder=CustomJSONEncoder)
+        data = {"user_id": "1", "user_info": {"b": 1, "a": Decimal("1.10")}}
+        expected = upstream.authenticate("presence-a", SOCKET_ID, data)
+        response = self.signer.authenticate("presence-a", SOCKET_ID, data)
+        self.assertNotEqual(expected["channel_data"],
+                            response["channel_data"])
+        self.assertEqual('{"user_id":"1","user_info":{"a":"1.10","b":1}}',
+                         response["channel_data"])
+        self.assertEqual(json.loads(expected["channel_data"]),
+                         json.loads(response["channel_data"]))
+        self.assertEqual("KEY:" + sign("SUPERSECRET", "%s:presence-a:%s" % (
+            SOCKET_ID, response["channel_data"])), response["auth"])
+
+    def test_sign_and_verify(self):
+        for message in ("", '{"a": "b"}', u"\u2603" * 1000):
+            signature = sign("SUPERSECRET", message)
+            self.assertEqual(signature, self.signer.sign(message))
+            self.assertTrue(self.signer.verify(message, signature))
+            self.assertFalse(self.signer.verify(message + " ", signature))
+
+
 class PusherWebhookTest(unittest.TestCase):
     def setUp(self):
         self.app = Flask(__name__)
@@ -314,6 +900,66 @@ class PusherWebhookTest(unittest.TestCase):
         self.assertEqual(200, response.status_code)
         self.assertTrue(self._called)
 
+    def _post_events(self, events):
+        data = json.dumps({"time_ms": 1327078148132, "events": events})
+        with self.app.test_request_context():
+            url = url_for("pusher.events")
+            signature = self.pusher._sign(data)
+        return self.client.post(url, data=data, headers={
+            "Content-Type": "application/json",
+            "X-Pusher-Key": "KEY",
+            "X-Pusher-Signature": signature
+        })
+
+    def test_events_without_handlers(self):
+        response = self._post_events([])
+        self.assertEqual(404, response.status_code)
+
+    def test_events_invalid_signature(self):
+        self.pusher.webhooks.on("member_added")(lambda e: None)
+        with self.app.test_request_context():
+            url = url_for("pusher.events")
+        response = self.client.post(url, data="{}", headers={
+            "X-Pusher-Key": "KEY",
+            "X-Pusher-Signature": "x"
+        })
+        self.assertEqual(403, response.status_code)
+
+    def test_events_not_object(self):
+        self.pusher.webhooks.on("member_added")(lambda e: None)
+        data = "[]"
+        with self.app.test_request_context():
+            signature = self.pusher._sign(data)
+        response = self.client.post("/pusher/events", data=data, headers={
+            "Content-Type": "application/json",
+            "X-Pusher-Key": "KEY",
+            "X-Pusher-Signature": signature
+        })
+        self.assertEqual(400, response.status_code)
+
+    def test_events_dispatch(self):
+        received = []
+
+        @self.pusher.webhooks.on("member_added")
+        def member_added(event):
+            received.append(("member_added", event["user_id"]))
+
+        @self.pusher.webhooks.on("channel_occupied", prefix="presence-")
+        def occupied(event):
+            received.append(("channel_occupied", event["channel"]))
+
+        response = self._post_events([
+            {"name": "channel_occupied", "channel": "private-a"},
+            {"name": "channel_occupied", "channel": "presence-a"},
+            {"name": "member_added", "channel": "presence-a",
+             "user_id": "u1"},
+            {"name": "client_event", "channel": "presence-a",
+             "event": "client-x", "data": "{}"},
+        ])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([("channel_occupied", "presence-a"),
+                          ("member_added", "u1")], received)
+
     def test_hook_all_handlers(self):
         @self.pusher.webhooks.presence
         def h1():
@@ -324,5 +970,1619 @@ class PusherWebhookTest(unittest.TestCase):
             pass
 
 
+class PusherWebhookReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config.update({
+            "PUSHER_WEBHOOKS_DEDUPE_WINDOW": 60,
+            "PUSHER_WEBHOOKS_MAX_SKEW": 300,
+        })
+        self.pusher = Pusher(self.app)
+        self.client = self.app.test_client()
+        self.received = []
+
+        @self.pusher.webhooks.on("member_added")
+        def member_added(event):
+            self.received.append(event["user_id"])
+
+    def _post(self, user_id, time_ms=None):
+        if time_ms is None:
+            time_ms = int(time.time() * 1000)
+        data = json.dumps({"time_ms": time_ms, "events": [
+            {"name": "member_added", "channel": "presence-a",
+             "user_id": user_id}]})
+        with self.app.test_request_context():
+            signature = self.pusher._sign(data)
+        return self.client.post("/pusher/events", data=data, headers={
+            "Content-Type": "application/json",
+            "X-Pusher-Key": "KEY",
+            "X-Pusher-Signature": signature
+        })
+
+    def test_drop_duplicates(self):
+        time_ms = int(time.time() * 1000)
+        for user_id in ("u1", "u1", "u2", "u1"):
+            response = self._post(user_id, time_ms)
+            self.assertEqual(200, response.status_code)
+        self.assertEqual(["u1", "u2"], self.received)
+        self.assertEqual(2, self.pusher.webhooks.stats["duplicated"])
+
+    def test_retry_failed_handler(self):
+        failures = [ValueError("db down")]
+
+        @self.pusher.webhooks.on("member_added")
+        def fail(event):
+            if failures:
+                raise failures.pop()
+
+        time_ms = int(time.time() * 1000)
+        self.assertEqual(500, self._post("u1", time_ms).status_code)
+        self.assertEqual(200, self._post("u1", time_ms).status_code)
+        self.assertEqual(200, self._post("u1", time_ms).status_code)
+        self.assertEqual(["u1", "u1"], self.received)
+        self.assertEqual(1, self.pusher.webhooks.stats["duplicated"])
+
+    def test_forget_after_window(self):
+        time_ms = int(time.time() * 1000)
+        self._post("u1", time_ms)
+        with mock.patch("flask_pusher._now", return_value=_now() + 61):
+            self._post("u1", time_ms)
+        self.assertEqual(["u1", "u1"], self.received)
+        self.assertEqual(1, len(self.pusher.webhooks._replay_guard._seen))
+
+    def test_reject_skew(self):
+        now = time.time() * 1000
+        self.assertEqual(403, self._post("u1", now - 301000).status_code)
+        self.assertEqual(403, self._post("u1", now + 301000).status_code)
+        self.assertEqual(200, self._post("u1", now - 1000).status_code)
+        self.assertEqual(["u1"], self.received)
+
+
+class PusherPresenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config["PUSHER_PRESENCE_STORE"] = True
+
+    def _init(self):
+        self.pusher = Pusher(self.app)
+        self.presence = self.pusher.presence
+        self.client = self.app.test_client()
+
+    def _post(self, *events):
+        data = json.dumps({"time_ms": 1, "events": list(events)})
+        with self.app.test_request_context():
+            signature = self.pusher._sign(data)
+        response = self.client.post("/pusher/events", data=data, headers={
+            "Content-Type": "application/json",
+            "X-Pusher-Key": "KEY",
+            "X-Pusher-Signature": signature
+        })
+        self.assertEqual(200, response.status_code)
+
+    def _check_state(self):
+        self._post({"name": "channel_occupied", "channel": "private-a"},
+                   {"name": "channel_occupied", "channel": "presence-b"},
+                   {"name": "member_added", "channel": "presence-b",
+                    "user_id": "u1"},
+                   {"name": "member_added", "channel": "presence-b",
+                    "user_id": "u2"})
+        self.assertTrue(self.presence.is_occupied("private-a"))
+        self.assertFalse(self.presence.is_occupied("private-c"))
+        self.assertEqual(set(["u1", "u2"]), self.presence.members("presence-b"))
+        self.assertEqual(2, self.presence.count("presence-b"))
+
+        self._post({"name": "member_removed", "channel": "presence-b",
+                    "user_id": "u1"},
+                   {"name": "channel_vacated", "channel": "private-a"})
+        self.assertEqual(set(["u2"]), self.presence.members("presence-b"))
+        self.assertEqual(set(["presence-b"]), self.presence.channels())
+
+        self._post({"name": "channel_vacated", "channel": "presence-b"})
+        self.assertEqual(0, self.presence.count("presence-b"))
+        self.assertFalse(self.presence.is_occupied("presence-b"))
+
+    def test_memory_storage(self):
+        self._init()
+        self._check_state()
+
+    def test_redis_storage(self):
+        self.app.config["PUSHER_PRESENCE_STORE"] = RedisPresenceStorage(
+            FakeRedis())
+        self._init()
+        self._check_state()
+
+    def test_redis_replace_is_atomic(self):
+        storage = RedisPresenceStorage(FakeRedis())
+        storage.add_member("presence-a", "u1")
+        execute = FakePipeline.execute
+
+        def check_execute(pipe):
+            # nothing changed before the transaction is executed
+            self.assertTrue(storage.is_occupied("presence-a"))
+            self.assertEqual(set(["u1"]), storage.members("presence-a"))
+            execute(pipe)
+
+        with mock.patch.object(FakePipeline, "execute", check_execute):
+            storage.replace({"presence-a": ["u2"], "b": []})
+        self.assertEqual(set(["presence-a", "b"]), storage.channels())
+        self.assertEqual(set(["u2"]), storage.members("presence-a"))
+
+    def test_legacy_webhook_routes(self):
+        self._init()
+        self.pusher.webhooks.presence(lambda: None)
+        data = json.dumps({"time_ms": 1, "events": [
+            {"name": "member_added", "channel": "presence-b",
+             "user_id": "u1"}]})
+        with self.app.test_request_context():
+            signature = self.pusher._sign(data)
+        self.client.post("/pusher/events/presence", data=data, headers={
+            "X-Pusher-Key": "KEY",
+            "X-Pusher-Signature": signature
+        })
+        self.assertEqual(set(["u1"]), self.presence.members("presence-b"))
+
+    def test_reconcile(self):
+        self._init()
+        self._post({"name": "channel_occupied", "channel": "private-old"})
+        self.assertFalse(self.presence.synced)
+        with self.app.app_context():
+            client = self.pusher.client
+            with mock.patch.object(client, "channels_info", return_value={
+                    "channels": {"private-a": {}, "presence-b": {}}}), \
+                    mock.patch.object(client, "users_info", return_value={
+                        "users": [{"id": "u1"}, {"id": "u2"}]}) as users:
+                self.presence.reconcile()
+        users.assert_called_once_with("presence-b")
+        self.assertTrue(self.presence.synced)
+        self.assertEqual(set(["private-a", "presence-b"]),
+                         self.presence.channels())
+        self.assertEqual(set(["u1", "u2"]), self.presence.members("presence-b"))
+
+
+class PusherSkipVacantTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config["PUSHER_SKIP_VACANT"] = True
+
+    def _init(self):
+        self.pusher = Pusher(self.app)
+        self.presence = self.pusher.presence
+        self.presence.storage.occupy("a")
+        with self.app.app_context():
+            self.client = self.pusher.client
+        self.http = mock.patch.object(self.client._pusher_client.http,
+                                      "send_request", return_value={})
+        self.send_request = self.http.start()
+        self.addCleanup(self.http.stop)
+
+    def _sent(self):
+        return [r[0][0].params for r in self.send_request.call_args_list]
+
+    def test_fail_open_until_synced(self):
+        self._init()
+        self.client.trigger("b", "ev", "x")
+        self.assertEqual(1, self.send_request.call_count)
+        self.assertEqual(0, self.client.occupancy.suppressed)
+
+    def test_fail_closed(self):
+        self.app.config["PUSHER_SKIP_VACANT_FAIL_OPEN"] = False
+        self._init()
+        self.assertEqual({}, self.client.trigger("b", "ev", "x"))
+        self.assertEqual(0, self.send_request.call_count)
+
+    def test_skip_vacant_channels(self):
+        self._init()
+        self.presence.synced = True
+        self.assertEqual({}, self.client.trigger(["b", "c"], "ev", "x"))
+        self.client.trigger(["a", "b"], "ev", "x")
+        self.client.trigger_batch([
+            {"channel": "a", "name": "ev", "data": "1"},
+            {"channel": "c", "name": "ev", "data": "2"},
+        ])
+        self.assertEqual({}, self.client.trigger_batch([
+            {"channel": "c", "name": "ev", "data": "2"}]))
+        sent = self._sent()
+        self.assertEqual(["a"], sent[0]["channels"])
+        self.assertEqual(["a"], [e["channel"] for e in sent[1]["batch"]])
+        self.assertEqual(2, len(sent))
+        self.assertEqual(5, self.client.occupancy.suppressed)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class PusherRateLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config.update({
+            "PUSHER_RATE_LIMIT": 10,
+            "PUSHER_RATE_LIMIT_BURST": 4,
+        })
+        self.clock = FakeClock()
+        for target, new in (("flask_pusher._now", self.clock),
+                            ("flask_pusher.time.sleep", self.clock.sleep)):
+            patcher = mock.patch(target, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _init(self):
+        self.pusher = Pusher(self.app)
+        with self.app.app_context():
+            self.client = self.pusher.client
+        patcher = mock.patch.object(self.client._pusher_client.http,
+                                    "send_request", return_value={})
+        self.send_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_block(self):
+        self._init()
+        for channel in ("a", "b", "c", "d"):
+            self.client.trigger(channel, "ev", "x")
+        self.assertEqual([], self.clock.sleeps)
+        self.client.trigger("e", "ev", "x")
+        self.assertEqual([0.1], self.clock.sleeps)
+        self.assertEqual(5, self.send_request.call_count)
+
+    def test_block_timeout(self):
+        self.app.config["PUSHER_RATE_LIMIT_TIMEOUT"] = 0.05
+        self._init()
+        self.client.trigger(["a", "b", "c", "d"], "ev", "x")
+        self.assertRaises(RateLimitExceeded,
+                          self.client.trigger, "e", "ev", "x")
+
+    def test_drop(self):
+        self.app.config["PUSHER_RATE_LIMIT_MODE"] = "drop"
+        self._init()
+        self.client.trigger_batch([
+            {"channel": c, "name": "ev", "data": "x"} for c in "abcd"])
+        self.assertIsNone(self.client.trigger("e", "ev", "x"))
+        self.clock.now += 0.1
+        self.client.trigger("e", "ev", "x")
+        self.assertEqual(2, self.send_request.call_count)
+        self.assertEqual(1, self.client.limiter.dropped)
+
+    def test_internal_senders_block(self):
+        self.app.config.update({
+            "PUSHER_RATE_LIMIT_MODE": "drop",
+            "PUSHER_COLLECT": True,
+        })
+        self._init()
+        self.client.trigger(["a", "b", "c", "d"], "ev", "x")
+        with self.app.test_request_context():
+            self.client.trigger("e", "ev", 1)
+            self.client.trigger("f", "ev", 2)
+        # collected events are waited for, not dropped
+        self.assertEqual([0.2], self.clock.sleeps)
+        self.assertEqual(2, self.send_request.call_count)
+        self.assertEqual(0, self.client.limiter.dropped)
+
+    def test_channel_fairness(self):
+        self.app.config["PUSHER_RATE_LIMIT_MODE"] = "drop"
+        self._init()
+        results = [self.client.trigger("hot", "ev", "x") for _ in range(4)]
+        self.assertEqual([{}, {}, None, None], results)
+        self.assertEqual({}, self.client.trigger("cold", "ev", "x"))
+
+    def test_defer(self):
+        self.app.config.update({
+            "PUSHER_RATE_LIMIT_MODE": "defer",
+            "PUSHER_QUEUE_SIZE": 10,
+        })
+        self._init()
+        self.client.trigger(["a", "b", "c", "d"], "ev", "x")
+        with mock.patch.object(self.client.queue, "put") as put:
+            self.client.trigger("e", "ev", "x")
+        put.assert_called_once_with({"channel": "e", "name": "ev",
+                                     "data": "x"})
+        self.assertEqual(1, self.send_request.call_count)
+
+    def test_retry_after(self):
+        self._init()
+        self.send_request.side_effect = PusherRateLimited("429", 30)
+        self.assertRaises(PusherRateLimited,
+                          self.client.trigger, "a", "ev", "x")
+        self.send_request.side_effect = None
+        self.client.trigger("a", "ev", "x")
+        self.assertEqual([30], self.clock.sleeps)
+
+    def test_backend_retry_after_header(self):
+        del self.app.config["PUSHER_RATE_LIMIT"]
+        pusher = Pusher(self.app)
+        with self.app.app_context():
+            backend = pusher.client.http
+            response = mock.Mock(status_code=429, text="",
+                                 headers={"Retry-After": "2"})
+            with mock.patch.object(backend.session, "request",
+                                   return_value=response):
+                try:
+                    pusher.client.trigger("a", "ev", "x")
+                except PusherRateLimited as e:
+                    self.assertEqual(2, e.retry_after)
+                else:
+                    self.fail("PusherRateLimited not raised")
+
+
+class PusherBroadcastTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.pusher = Pusher(self.app)
+        self.channels = ["c%d" % i for i in range(250)]
+        with self.app.app_context():
+            self.client = self.pusher.client
+
+    def _broadcast(self, side_effect=None, **kwargs):
+        calls = []
+        lock = threading.Lock()
+
+        def trigger(channels, event_name, data, socket_id=None):
+            with lock:
+                calls.append((list(channels), data))
+            if side_effect:
+                side_effect(channels)
+            return {}
+
+        with mock.patch.object(self.client, "_trigger_now",
+                               side_effect=trigger):
+            with self.app.app_context():
+                result = self.pusher.broadcast(self.channels, "ev",
+                                               {"x": 1}, **kwargs)
+        return result, calls
+
+    def test_chunks(self):
+        result, calls = self._broadcast()
+        self.assertTrue(result.ok)
+        self.assertEqual([50, 100, 100],
+                         sorted(len(chunk) for chunk, data in calls))
+        self.assertEqual(set(self.channels),
+                         set(c for chunk in result.succeeded for c in chunk))
+        # data is encoded once
+        self.assertEqual(set(['{"x": 1}']), set(data for c, data in calls))
+
+    @unittest.skipIf(generate_shared_secret is None,
+                     "encrypted channels require pusher>=2.1")
+    def test_encrypted_channels(self):
+        self.channels = ["a", "private-encrypted-1", "private-encrypted-2"]
+        result, calls = self._broadcast()
+        self.assertEqual([["a"], ["private-encrypted-1"],
+                          ["private-encrypted-2"]],
+                         sorted(chunk for chunk, data in calls))
+
+    def test_retry_failed_chunks(self):
+        failures = [ValueError()]
+
+        def fail_once(channels):
+            if channels[0] == "c200" and failures:
+                raise failures.pop()
+
+        result, calls = self._broadcast(fail_once)
+        self.assertTrue(result.ok)
+        self.assertEqual(4, len(calls))
+        self.assertEqual("c200", calls[-1][0][0])
+
+    def test_failed_chunks(self):
+        def fail(channels):
+            if channels[0] == "c200":
+                raise ValueError()
+
+        result, calls = self._broadcast(fail, retries=2)
+        self.assertFalse(result.ok)
+        self.assertEqual(2, len(result.succeeded))
+        [(chunk, error)] = result.failed
+        self.assertEqual(self.channels[200:], chunk)
+        self.assertIsInstance(error, ValueError)
+        self.assertEqual(5, len(calls))
+
+    def test_app_context_in_workers(self):
+        apps = []
+
+        def record_app(channels):
+            apps.append(current_app._get_current_object())
+
+        result, calls = self._broadcast(record_app)
+        self.assertTrue(result.ok)
+        self.assertEqual([self.app] * 3, apps)
+
+    def test_sequential(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config["PUSHER_BROADCAST_WORKERS"] = 1
+        self.pusher = Pusher(self.app)
+        with self.app.app_context():
+            self.client = self.pusher.client
+        self.assertIsNone(self.client.broadcast_pool)
+        result, calls = self._broadcast()
+        self.assertEqual([100, 100, 50], [len(c) for c, d in calls])
+
+
+class PusherPayloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config["PUSHER_MAX_PAYLOAD"] = 1000
+
+    def _init(self):
+        self.pusher = Pusher(self.app)
+        with self.app.app_context():
+            self.client = self.pusher.client
+        patcher = mock.patch.object(self.client._pusher_client.http,
+                                    "send_request", return_value={})
+        self.send_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _sent(self):
+        return [r[0][0].params for r in self.send_request.call_args_list]
+
+    def test_reject_before_sending(self):
+        self._init()
+        self.assertRaises(PayloadTooLarge, self.client.trigger,
+                          "a", "ev", {"x": "y" * 1000})
+        self.assertRaises(PayloadTooLarge, self.client.trigger_batch,
+                          [{"channel": "a", "name": "ev", "data": "y" * 1001}])
+        self.assertEqual(0, self.send_request.call_count)
+        self.client.trigger("a", "ev", "y" * 1000)
+        self.assertEqual(1, self.send_request.call_count)
+
+    def test_truncate(self):
+        self.app.config["PUSHER_OVERSIZE"] = "truncate"
+        self._init()
+
+        @self.pusher.truncate
+        def truncate(data, max_size):
+            return dict(data, text=data["text"][:max_size - 100])
+
+        self.client.trigger("a", "ev", {"text": "y" * 2000})
+        data = json.loads(self._sent()[0]["data"])
+        self.assertEqual(900, len(data["text"]))
+
+    def test_split(self):
+        self.app.config["PUSHER_OVERSIZE"] = "split"
+        self._init()
+        data = {"text": u"\u2603\"" * 1000}
+        self.client.trigger_batch([
+            {"channel": "a", "name": "small", "data": {"x": 1}},
+            {"channel": "a", "name": "big", "data": data},
+        ])
+        events = [e for p in self._sent() for e in p["batch"]]
+        self.assertEqual("small", events[0]["name"])
+        chunks = [json.loads(e["data"]) for e in events[1:]]
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(set(["chunked-big"]),
+                         set(e["name"] for e in events[1:]))
+        for index, chunk in enumerate(chunks):
+            self.assertEqual(index, chunk["index"])
+            self.assertEqual(index == len(chunks) - 1, chunk["final"])
+        for event in events:
+            self.assertTrue(len(event["data"].encode("utf-8")) <= 1000)
+        joined = "".join(chunk["chunk"] for chunk in chunks)
+        self.assertEqual(data, json.loads(joined))
+
+    def test_split_small_max_payload(self):
+        self.app.config["PUSHER_OVERSIZE"] = "split"
+        self.app.config["PUSHER_MAX_PAYLOAD"] = 100
+        self.assertRaises(ValueError, self._init)
+
+        encoder = _PayloadEncoder(max_size=101, oversize="split")
+        chunks = encoder.prepare("ev", "x" * 200)
+        self.assertEqual(200, len(chunks))
+        # no chunk can hold a single character
+        encoder.max_size = 85
+        self.assertRaises(PayloadTooLarge, encoder.prepare,
+                          "ev", u"\U0001F600" * 30)
+
+    def test_chunked_js(self):
+        self._init()
+        response = self.app.test_client().get("/pusher/chunked.js")
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b"bindChunked", response.data)
+
+    def test_encode_cache(self):
+        self.app.config["PUSHER_ENCODE_CACHE_SIZE"] = 2
+        self._init()
+        data = {"x": 1}
+        with mock.patch("flask_pusher.data_to_string",
+                        wraps=data_to_string) as encode:
+            for channel in ("a", "b", "c"):
+                self.client.trigger(channel, "ev", data)
+        self.assertEqual(1, encode.call_count)
+        self.assertEqual(3, self.send_request.call_count)
+
+
+class PusherMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.registry = MetricsRegistry()
+        self.app.config.update({
+            "PUSHER_METRICS": [self.registry, RequestMetrics()],
+            "PUSHER_METRICS_ENDPOINT": "/metrics",
+        })
+        self.pusher = Pusher(self.app)
+        self.pusher.auth(lambda c, s: "b" not in c)
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            http = self.pusher.client._pusher_client.http
+        patcher = mock.patch.object(http, "send_request", return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_without_blinker(self):
+        class FakeSignal(object):
+            # the signal of Flask<2.3 without blinker
+            def send(self, *args, **kwargs):
+                pass
+
+        signals = dict((metric, FakeSignal()) for metric in _metric_signals)
+        with mock.patch.dict(_metric_signals, signals):
+            app = Flask(__name__)
+            app.config.update(pusher_conf)
+            pusher = Pusher(app)
+            pusher.auth(lambda c, s: True)
+            response = app.test_client().post("/pusher/auth", data={
+                "channel_name": "private-a", "socket_id": SOCKET_ID})
+            self.assertEqual(200, response.status_code)
+            with app.app_context():
+                with mock.patch.object(pusher.client._pusher_client.http,
+                                       "send_request", return_value={}):
+                    self.assertEqual({}, pusher.client.trigger("a", "ev",
+                                                               "x"))
+
+    def test_registry(self):
+        self.client.post("/pusher/auth", data={"channel_name[0]": "private-a",
+                                               "channel_name[1]": "private-b",
+                                               "socket_id": SOCKET_ID})
+        self.client.post("/pusher/auth", data={"channel_name": "private-b",
+                                               "socket_id": SOCKET_ID})
+        self.pusher.webhooks.on("member_added")(lambda event: None)
+        self.client.post("/pusher/events", headers={
+            "X-Pusher-Key": "KEY", "X-Pusher-Signature": "x"})
+        with self.app.app_context():
+            self.pusher.client.trigger(["a", "b"], "ev", "x")
+
+        response = self.client.get("/pusher/metrics")
+        self.assertEqual(200, response.status_code)
+        text = response.data.decode()
+        self.assertIn('flask_pusher_auth_seconds_count{outcome="ok"} 1', text)
+        self.assertIn('flask_pusher_auth_seconds_count{outcome="403"} 1',
+                      text)
+        self.assertIn(
+            'flask_pusher_auth_handler_channels_total{outcome="ok"} 3', text)
+        self.assertIn(
+            'flask_pusher_webhook_verify_seconds_count{outcome="invalid"} 1',
+            text)
+        self.assertIn('flask_pusher_trigger_seconds_bucket'
+                      '{outcome="ok",le="+Inf"} 1', text)
+        self.assertIn('flask_pusher_trigger_channels_total{outcome="ok"} 2',
+                      text)
+
+    def test_request_summary(self):
+        with self.app.test_request_context():
+            self.pusher.client.trigger("a", "ev", "x")
+            self.pusher.client.trigger("b", "ev", "x")
+            self.assertEqual(2, g.pusher_metrics["trigger"]["count"])
+
+    def test_signals(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append((sender, kwargs))
+
+        with trigger_sent.connected_to(receiver):
+            with self.app.app_context():
+                self.pusher.client.trigger_batch([
+                    {"channel": "a", "name": "ev", "data": "x"}])
+        [(sender, kwargs)] = received
+        self.assertIs(self.app, sender)
+        self.assertEqual("ok", kwargs["outcome"])
+        self.assertEqual("trigger_batch", kwargs["method"])
+        self.assertEqual(1, kwargs["channels"])
+        self.assertTrue(kwargs["duration"] >= 0)
+
+    def test_disabled(self):
+        app = Flask(__name__)
+        app.config.update(pusher_conf)
+        pusher = Pusher(app)
+        with app.app_context():
+            self.assertFalse(pusher.client.metrics.enabled("trigger"))
+        self.assertEqual(404, app.test_client().get(
+            "/pusher/metrics").status_code)
+
+
+class PusherAsyncWebhookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config.update({
+            "PUSHER_WEBHOOKS_ASYNC": True,
+            "PUSHER_WEBHOOKS_WORKERS": 1,
+            "PUSHER_WEBHOOKS_QUEUE_SIZE": 1,
+        })
+        self.pusher = Pusher(self.app)
+        self.client = self.app.test_client()
+        self.release = threading.Event()
+        self.received = []
+
+        @self.pusher.webhooks.client
+        def client_webhook():
+            self.release.wait(5)
+            self.received.append(request.json)
+
+        @self.pusher.webhooks.on("member_added")
+        def member_added(event):
+            if event["user_id"] == "error":
+                raise ValueError()
+            self.received.append(event["user_id"])
+
+    def tearDown(self):
+        self.release.set()
+        self.pusher.webhooks._executor.close()
+
+    def _post(self, endpoint, data):
+        data = json.dumps(data)
+        with self.app.test_request_context():
+            url = url_for(endpoint)
+            signature = self.pusher._sign(data)
+        return self.client.post(url, data=data, headers={
+            "Content-Type": "application/json",
+            "X-Pusher-Key": "KEY",
+            "X-Pusher-Signature": signature
+        })
+
+    def test_acknowledge_before_processing(self):
+        response = self._post("pusher.client_event", {"n": 1})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([], self.received)
+        self.release.set()
+        self.pusher.webhooks._executor.join()
+        self.assertEqual([{"n": 1}], self.received)
+        self.assertEqual(1, self.pusher.webhooks.stats["processed"])
+
+    def test_invalid_signature_inline(self):
+        response = self.client.post("/pusher/events/client", headers={
+            "X-Pusher-Key": "KEY",
+            "X-Pusher-Signature": "x"
+        })
+        self.assertEqual(403, response.status_code)
+        self.assertEqual(0, self.pusher.webhooks.stats["queued"])
+
+    def test_load_shedding(self):
+        statuses = [self._post("pusher.client_event", {"n": i}).status_code
+                    for i in range(3)]
+        self.assertEqual(503, statuses[-1])
+        stats = self.pusher.webhooks.stats
+        self.assertEqual(statuses.count(503), stats["rejected"])
+        self.release.set()
+        self.pusher.webhooks._executor.close()
+        self.assertEqual(statuses.count(200), len(self.received))
+        self.assertEqual(stats["queued"], stats["processed"])
+
+    def test_failed_counter(self):
+        self.release.set()
+        for user_id in ("u1", "error"):
+            self._post("pusher.events", {"time_ms": 1, "events": [
+                {"name": "member_added", "channel": "presence-a",
+                 "user_id": user_id}]})
+            self.pusher.webhooks._executor.join()
+        self.assertEqual(["u1"], self.received)
+        self.assertEqual(1, self.pusher.webhooks.stats["processed"])
+        self.assertEqual(1, self.pusher.webhooks.stats["failed"])
+
+
+class PusherTenantTest(unittest.TestCase):
+
+    tenants = {
+        "acme": {"app_id": "1", "key": "ACME", "secret": "ACMESECRET"},
+        "initech": {"app_id": "2", "key": "INITECH",
+                    "secret": "INITECHSECRET"},
+    }
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config["PUSHER_TENANT_CACHE_SIZE"] = 1
+        self.pusher = Pusher(self.app)
+        self.resolved = []
+        self.events = []
+
+        @self.pusher.tenant
+        def tenant(key):
+            self.resolved.append(key)
+            if key is not None:
+                for credentials in self.tenants.values():
+                    if credentials["key"] == key:
+                        return credentials
+                return None
+            return self.tenants.get(request.args.get("tenant"))
+
+        @self.pusher.auth
+        def auth(channel_name, socket_id):
+            return True
+
+        @self.pusher.webhooks.on("channel_occupied")
+        def occupied(event):
+            self.events.append((self.pusher.client.key, event["channel"]))
+
+    def _client(self, tenant=None):
+        url = "/?tenant=%s" % tenant if tenant else "/"
+        with self.app.test_request_context(url):
+            client = self.pusher.client
+            self.assertIs(client, self.pusher.client)
+            return client
+
+    def test_client_per_tenant(self):
+        acme = self._client("acme")
+        self.assertEqual("ACME", acme.key)
+        self.assertEqual("ACMESECRET", acme.secret)
+        self.assertIs(acme, self._client("acme"))
+        self.assertEqual([None, None], self.resolved)
+
+    def test_default_client(self):
+        client = self._client()
+        self.assertEqual("KEY", client.key)
+        self.assertIs(client, self.app.extensions["pusher"])
+
+    def test_evict_least_recently_used(self):
+        acme = self._client("acme")
+        with mock.patch.object(acme, "close") as close:
+            initech = self._client("initech")
+        self.assertTrue(close.called)
+        self.assertEqual("INITECH", initech.key)
+        self.assertIsNot(acme, self._client("acme"))
+
+    def test_rebuild_on_new_credentials(self):
+        acme = self._client("acme")
+        self.tenants = dict(self.tenants, acme=dict(self.tenants["acme"],
+                                                    secret="ROTATED"))
+        with mock.patch.object(acme, "close") as close:
+            client = self._client("acme")
+        self.assertTrue(close.called)
+        self.assertEqual("ROTATED", client.secret)
+
+    def test_auth_with_tenant_secret(self):
+        response = self.app.test_client().post(
+            "/pusher/auth?tenant=acme",
+            data={"channel_name": "private-a", "socket_id": "1.42"})
+        self.assertEqual(200, response.status_code)
+        expected = "ACME:" + sign("ACMESECRET", "1.42:private-a")
+        self.assertEqual(expected, json.loads(response.data)["auth"])
+
+    def test_auth_cache_per_tenant(self):
+        app = Flask(__name__)
+        app.config.update(pusher_conf)
+        app.config["PUSHER_AUTH_CACHE_TTL"] = 60
+        pusher = Pusher(app)
+        pusher.tenant(lambda key: self.tenants.get(request.args.get("tenant")))
+        pusher.identity(lambda: "u1")
+        allowed = set(["acme"])
+        pusher.auth(lambda c, s: request.args.get("tenant") in allowed)
+
+        def auth(tenant):
+            return app.test_client().post(
+                "/pusher/auth?tenant=%s" % tenant,
+                data={"channel_name": "private-a", "socket_id": "1.42"})
+
+        self.assertEqual(200, auth("acme").status_code)
+        # same user and channel, not allowed by the cache of another tenant
+        self.assertEqual(403, auth("initech").status_code)
+        allowed.add("initech")
+        self.assertEqual(403, auth("initech").status_code)
+        with app.test_request_context("/?tenant=initech"):
+            pusher.invalidate("u1")
+        self.assertEqual(200, auth("initech").status_code)
+        allowed.clear()
+        self.assertEqual(200, auth("acme").status_code)
+        with app.app_context():
+            pusher.invalidate("u1", key="ACME")
+        self.assertEqual(403, auth("acme").status_code)
+
+    def _webhook(self, key, secret):
+        body = json.dumps({"time_ms": 1, "events": [
+            {"name": "channel_occupied", "channel": "a"}]})
+        response = self.app.test_client().post(
+            "/pusher/events", data=body, headers={
+                "X-Pusher-Key": key,
+                "X-Pusher-Signature": sign(secret, body),
+            })
+        return response.status_code
+
+    def test_webhook_with_tenant_secret(self):
+        self.assertEqual(200, self._webhook("INITECH", "INITECHSECRET"))
+        self.assertEqual(["INITECH"], self.resolved)
+        self.assertEqual([("INITECH", "a")], self.events)
+        # cached client, no resolver call
+        self.assertEqual(200, self._webhook("INITECH", "INITECHSECRET"))
+        self.assertEqual(["INITECH"], self.resolved)
+
+    def test_webhook_with_wrong_secret(self):
+        self.assertEqual(403, self._webhook("INITECH", "ACMESECRET"))
+        self.assertEqual(403, self._webhook("UNKNOWN", "SUPERSECRET"))
+        self.assertEqual(200, self._webhook("KEY", "SUPERSECRET"))
+        self.assertEqual([("KEY", "a")], self.events)
+
+
+class PusherInfoCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config.update({
+            "PUSHER_INFO_CACHE_TTL": 10,
+            "PUSHER_INFO_CACHE_STALE": 60,
+            "PUSHER_INFO_CACHE_SIZE": 2,
+        })
+        self.pusher = Pusher(self.app)
+        with self.app.app_context():
+            self.client = self.pusher.client
+        self.clock = FakeClock()
+        patcher = mock.patch("flask_pusher._now", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fetched = []
+
+        def send_request(request):
+            # /apps/<app_id>/channels/<channel>/users
+            self.fetched.append(request.path.split("/")[4])
+            return {"users": [{"id": len(self.fetched)}]}
+
+        patcher = mock.patch.object(self.client._pusher_client.http,
+                                    "send_request", side_effect=send_request)
+        self.send_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _users(self, channel, **kwargs):
+        return self.client.users_info(channel, **kwargs)["users"][0]["id"]
+
+    def test_cached(self):
+        self.assertEqual(1, self._users("presence-a"))
+        self.clock.now += 9
+        self.assertEqual(1, self._users("presence-a"))
+        self.assertEqual(["presence-a"], self.fetched)
+
+    def test_per_call_ttl(self):
+        self.assertEqual(1, self._users("presence-a"))
+        self.assertEqual(2, self._users("presence-a", cache_ttl=0))
+        self.clock.now += 15
+        self.assertEqual(1, self._users("presence-a", cache_ttl=20))
+        self.assertEqual(2, len(self.fetched))
+
+    def test_stale_while_revalidate(self):
+        self.assertEqual(1, self._users("presence-a"))
+        self.clock.now += 30
+        self.assertEqual(1, self._users("presence-a"))
+        deadline = time.time() + 5
+        while len(self.fetched) < 2:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        self.assertEqual(2, self._users("presence-a"))
+        self.clock.now += 100
+        self.assertEqual(3, self._users("presence-a"))
+
+    def test_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def send_request(request):
+            started.set()
+            release.wait(5)
+            self.fetched.append(request.path.split("/")[4])
+            return {"users": [{"id": 42}]}
+
+        results = []
+        self.send_request.side_effect = send_request
+        threads = [threading.Thread(
+            target=lambda: results.append(self._users("presence-a")))
+            for _ in range(10)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # let the other threads wait for the fetch
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([42] * 10, results)
+        self.assertEqual(["presence-a"], self.fetched)
+
+    def test_bounded(self):
+        for channel in ("presence-a", "presence-b", "presence-c"):
+            self._users(channel)
+        self._users("presence-c")
+        self._users("presence-a")
+        self.assertEqual(["presence-a", "presence-b", "presence-c",
+                          "presence-a"], self.fetched)
+
+    def test_invalidate_from_webhook(self):
+        self.pusher.webhooks.on("member_added")(lambda event: None)
+        self._users("presence-a")
+        self._users("presence-b")
+        data = json.dumps({"time_ms": 1, "events": [
+            {"name": "member_added", "channel": "presence-a",
+             "user_id": "u1"}]})
+        with self.app.test_request_context():
+            signature = self.pusher._sign(data)
+        response = self.app.test_client().post(
+            "/pusher/events", data=data, headers={
+                "X-Pusher-Key": "KEY",
+                "X-Pusher-Signature": signature,
+            })
+        self.assertEqual(200, response.status_code)
+        self._users("presence-a")
+        self._users("presence-b")
+        self.assertEqual(["presence-a", "presence-b", "presence-a"],
+                         self.fetched)
+
+
+class PusherCircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = benchmarks.FakePusherAPI().start()
+        self.addCleanup(self.api.stop)
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config.update(self.api.config)
+        self.app.config.update({
+            "PUSHER_CIRCUIT_BREAKER": True,
+            "PUSHER_CIRCUIT_MIN_REQUESTS": 4,
+            "PUSHER_CIRCUIT_RESET_TIMEOUT": 0.2,
+        })
+
+    def _init(self):
+        self.pusher = Pusher(self.app)
+        with self.app.app_context():
+            self.client = self.pusher.client
+
+    def _fail(self, count):
+        for _ in range(count):
+            self.assertRaises(PusherBadStatus, self.client.trigger,
+                              "a", "ev", "x")
+
+    def test_open_on_errors(self):
+        self._init()
+        self.client.trigger("a", "ev", "x")
+        self.api.status = 500
+        self._fail(2)
+        self.assertEqual("closed", self.client.breaker.state)
+        self._fail(1)
+        self.assertEqual("open", self.client.breaker.state)
+        self.assertRaises(CircuitOpen, self.client.trigger, "a", "ev", "x")
+        self.assertRaises(CircuitOpen, self.client.channels_info)
+        self.assertEqual(4, len(self.api.requests))
+        self.assertEqual({"state": "open", "requests": 4, "failures": 3},
+                         self.client.breaker.stats())
+
+    def test_refused_requests_are_not_failures(self):
+        self._init()
+        self.api.status = 400
+        for _ in range(5):
+            self.assertRaises(PusherBadRequest, self.client.trigger,
+                              "a", "ev", "x")
+        self.assertEqual("closed", self.client.breaker.state)
+
+    def test_open_on_slow_requests(self):
+        self.app.config["PUSHER_CIRCUIT_SLOW"] = 0.01
+        self._init()
+        self.api.latency = 0.05
+        for _ in range(4):
+            self.client.trigger("a", "ev", "x")
+        self.assertEqual("open", self.client.breaker.state)
+
+    def test_half_open_probe(self):
+        self._init()
+        self.api.status = 500
+        self._fail(4)
+        self.assertEqual("open", self.client.breaker.state)
+        time.sleep(0.25)
+        self._fail(1)
+        self.assertEqual("open", self.client.breaker.state)
+        self.assertRaises(CircuitOpen, self.client.trigger, "a", "ev", "x")
+        time.sleep(0.25)
+        self.api.status = 200
+        self.assertEqual({}, self.client.trigger("a", "ev", "x"))
+        self.assertEqual("closed", self.client.breaker.state)
+        self.assertEqual(6, len(self.api.requests))
+
+    def test_probe_interrupted(self):
+        class Timeout(BaseException):
+            # like gevent.Timeout
+            pass
+
+        self._init()
+        self.api.status = 500
+        self._fail(4)
+        time.sleep(0.25)
+        backend = self.client._pusher_client.http.backend
+        with mock.patch.object(backend, "send_request", side_effect=Timeout):
+            self.assertRaises(Timeout, self.client.trigger, "a", "ev", "x")
+        self.assertEqual("open", self.client.breaker.state)
+        time.sleep(0.25)
+        self.api.status = 200
+        self.assertEqual({}, self.client.trigger("a", "ev", "x"))
+        self.assertEqual("closed", self.client.breaker.state)
+
+    def test_fallback(self):
+        self._init()
+        diverted = []
+
+        @self.pusher.circuit_fallback
+        def fallback(events):
+            diverted.extend(events)
+            return "diverted"
+
+        self.api.status = 500
+        self._fail(4)
+        self.assertEqual("diverted", self.client.trigger(
+            ["a", "b"], "ev", "x", "1.42"))
+        self.assertEqual("diverted", self.client.trigger_batch(
+            [{"channel": "c", "name": "ev", "data": "y"}]))
+        self.assertEqual([
+            {"channel": "a", "name": "ev", "data": "x", "socket_id": "1.42"},
+            {"channel": "b", "name": "ev", "data": "x", "socket_id": "1.42"},
+            {"channel": "c", "name": "ev", "data": "y"},
+        ], diverted)
+        self.assertEqual(4, len(self.api.requests))
+
+
+class PusherCollectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config["PUSHER_COLLECT"] = True
+
+        @self.app.route("/update")
+        def update():
+            for i in range(int(request.args.get("rows", 5))):
+                channel = "doc-%d" % (i % int(request.args.get("docs", 1)))
+                self.pusher.client.trigger(channel, "document-changed",
+                                           {"row": i})
+            if request.args.get("fail"):
+                raise ValueError("rollback")
+            return "OK"
+
+    def _init(self):
+        self.pusher = Pusher(self.app)
+        with self.app.app_context():
+            self.client = self.pusher.client
+        patcher = mock.patch.object(self.client._pusher_client.http,
+                                    "send_request", return_value={})
+        self.send_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _batches(self):
+        return [[(e["channel"], json.loads(e["data"])["row"])
+                 for e in call[0][0].params["batch"]]
+                for call in self.send_request.call_args_list]
+
+    def test_last_write_wins(self):
+        self._init()
+        self.app.test_client().get("/update?rows=5")
+        self.assertEqual([[("doc-0", 4)]], self._batches())
+
+    def test_send_without_response(self):
+        self.app.config.update({
+            "PUSHER_WEBHOOKS_ASYNC": True,
+            "PUSHER_WEBHOOKS_WORKERS": 1,
+        })
+        self._init()
+        self.addCleanup(self.pusher.webhooks._executor.close)
+
+        @self.pusher.webhooks.on("member_added")
+        def member_added(event):
+            self.pusher.client.trigger("doc-0", "document-changed",
+                                       {"row": 1})
+
+        data = json.dumps({"time_ms": 1, "events": [
+            {"name": "member_added", "channel": "presence-a",
+             "user_id": "u1"}]})
+        with self.app.test_request_context():
+            signature = self.pusher._sign(data)
+        self.app.test_client().post("/pusher/events", data=data, headers={
+            "Content-Type": "application/json",
+            "X-Pusher-Key": "KEY",
+            "X-Pusher-Signature": signature,
+        })
+        self.pusher.webhooks._executor.join()
+        self.assertEqual([[("doc-0", 1)]], self._batches())
+
+        with self.app.test_request_context():
+            self.client.trigger("doc-1", "document-changed", {"row": 2})
+        self.assertEqual([("doc-1", 2)], self._batches()[-1])
+
+    def test_fewest_batches(self):
+        self._init()
+        self.app.test_client().get("/update?rows=24&docs=12")
+        batches = self._batches()
+        self.assertEqual([10, 2], [len(batch) for batch in batches])
+        self.assertEqual(["doc-%d" % i for i in range(12)],
+                         [channel for batch in batches
+                          for channel, row in batch])
+
+    def test_discard_on_exception(self):
+        self._init()
+        self.assertEqual(500, self.app.test_client().get(
+            "/update?fail=1").status_code)
+        self.assertEqual(0, self.send_request.call_count)
+
+    def test_discard_on_error_response(self):
+        self._init()
+
+        @self.app.route("/conflict")
+        def conflict():
+            self.pusher.client.trigger("a", "ev", {"row": 1})
+            abort(409)
+
+        self.assertEqual(409, self.app.test_client().get(
+            "/conflict").status_code)
+        self.assertEqual(0, self.send_request.call_count)
+
+    def test_multi_channel_triggers(self):
+        self._init()
+        channels = ["c%d" % i for i in range(150)]
+
+        @self.app.route("/broadcast")
+        def broadcast():
+            client = self.pusher.client
+            client.trigger(channels[:50], "ev", {"row": 1})
+            client.trigger("c0", "other", {"row": 2})
+            client.trigger(channels[50:], "ev", {"row": 1})
+            client.trigger("c1", "ev", {"row": 1}, SOCKET_ID)
+            return "OK"
+
+        self.app.test_client().get("/broadcast")
+        requests = [(call[0][0].path, call[0][0].params)
+                    for call in self.send_request.call_args_list]
+        self.assertEqual("/apps/1234/events", requests[0][0])
+        self.assertEqual(channels[:100], requests[0][1]["channels"])
+        self.assertEqual("/apps/1234/batch_events", requests[1][0])
+        self.assertEqual(["other"],
+                         [e["name"] for e in requests[1][1]["batch"]])
+        self.assertEqual(channels[100:], requests[2][1]["channels"])
+        self.assertEqual([("c1", SOCKET_ID)],
+                         [(e["channel"], e["socket_id"])
+                          for e in requests[3][1]["batch"]])
+        self.assertEqual(4, len(requests))
+
+    def test_keep_channel_order(self):
+        self.app.config["PUSHER_COLLECT_MERGE"] = "all"
+        self._init()
+
+        @self.app.route("/ordered")
+        def ordered():
+            client = self.pusher.client
+            client.trigger("a", "ev", {"row": 1})
+            client.trigger("b", "other", {"row": 2})
+            client.trigger(["b", "c"], "ev", {"row": 1})
+            return "OK"
+
+        self.app.test_client().get("/ordered")
+        params = [call[0][0].params
+                  for call in self.send_request.call_args_list]
+        # b can't join the first "ev" trigger, sent before its "other"
+        self.assertEqual([("a", "ev"), ("b", "other")],
+                         [(e["channel"], e["name"])
+                          for e in params[0]["batch"]])
+        self.assertEqual(["b", "c"], params[1]["channels"])
+
+    def test_keep_all(self):
+        self.app.config["PUSHER_COLLECT_MERGE"] = "all"
+        self._init()
+        self.app.test_client().get("/update?rows=3")
+        self.assertEqual([[("doc-0", 0), ("doc-0", 1), ("doc-0", 2)]],
+                         self._batches())
+
+    def test_keep_all_identical(self):
+        self.app.config["PUSHER_COLLECT_MERGE"] = "all"
+        self._init()
+
+        @self.app.route("/ping")
+        def ping():
+            self.pusher.client.trigger("a", "ping", {"row": 1})
+            self.pusher.client.trigger(["a", "b"], "ping", {"row": 1})
+            return "OK"
+
+        self.app.test_client().get("/ping")
+        # each event is delivered, never to a channel repeated in a trigger
+        params = [call[0][0].params
+                  for call in self.send_request.call_args_list]
+        self.assertEqual(["a"], [e["channel"] for e in params[0]["batch"]])
+        self.assertEqual(["a", "b"], params[1]["channels"])
+
+    def test_custom_merge(self):
+        self._init()
+
+        @self.pusher.merge
+        def merge(channel, event_name, previous, data):
+            return {"row": previous["row"] + data["row"]}
+
+        self.app.test_client().get("/update?rows=5")
+        self.assertEqual([[("doc-0", 10)]], self._batches())
+
+    def test_outside_request(self):
+        self._init()
+        with self.app.app_context():
+            self.client.trigger("a", "ev", {"row": 1})
+        self.assertEqual(1, self.send_request.call_count)
+        self.assertEqual("/apps/1234/events",
+                         self.send_request.call_args[0][0].path)
+
+    def test_invalid_merge(self):
+        self.app.config["PUSHER_COLLECT_MERGE"] = "first"
+        self.assertRaises(ValueError, Pusher, self.app)
+
+
+class PusherOutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "outbox.db")
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config.update({
+            "PUSHER_OUTBOX": self.path,
+            "PUSHER_OUTBOX_POLL_INTERVAL": 0.01,
+        })
+        patcher = mock.patch("flask_pusher_client.PooledBackend.send_request",
+                             return_value={})
+        self.send_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _init(self):
+        self.pusher = Pusher(self.app)
+        with self.app.app_context():
+            self.client = self.pusher.client
+        self.addCleanup(self.client.close)
+
+        @self.app.route("/order/<int:n>")
+        def order(n):
+            for i in range(n):
+                self.pusher.outbox("orders", "created", {"id": i})
+            if request.args.get("fail"):
+                raise ValueError("rollback")
+            return "OK"
+
+    def _pending(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute(
+                "SELECT COUNT(*) FROM pusher_outbox").fetchone()[0]
+        finally:
+            conn.close()
+
+    def _sent(self):
+        events = []
+        for call in self.send_request.call_args_list:
+            events.extend(call[0][0].params["batch"])
+        return events
+
+    def _wait_sent(self, count):
+        deadline = time.time() + 5
+        while len(self._sent()) < count or self._pending():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_send_after_request(self):
+        self._init()
+        response = self.app.test_client().get("/order/12")
+        self.assertEqual(200, response.status_code)
+        self._wait_sent(12)
+        events = self._sent()
+        self.assertEqual(list(range(12)),
+                         [json.loads(e["data"])["id"] for e in events])
+        self.assertEqual(set(["orders"]), set(e["channel"] for e in events))
+        # batches of 10 events
+        self.assertEqual(2, self.send_request.call_count)
+
+    def test_drop_events_of_failed_request(self):
+        self._init()
+        self.assertEqual(500, self.app.test_client().get(
+            "/order/3?fail=1").status_code)
+        self.client.spool.close()
+        self.assertEqual(0, self._pending())
+        self.assertEqual([], self._sent())
+
+    def test_spool_unavailable(self):
+        self._init()
+        spool = self.client.spool
+        spool.close()
+        event = {"channel": "orders", "name": "created", "data": "1"}
+        connect = spool._connect
+        unavailable = [True]
+
+        def open_spool():
+            if unavailable:
+                raise sqlite3.OperationalError("unable to open database")
+            return connect()
+
+        with mock.patch.object(spool, "_connect", open_spool):
+            spool.start()
+            self.assertRaises(sqlite3.OperationalError, spool.append, [event])
+            # the writer is still running
+            unavailable.pop()
+            spool.append([event])
+            self._wait_sent(1)
+
+    def test_spool_write_timeout(self):
+        self._init()
+        spool = self.client.spool
+        spool.write_timeout = 0.01
+        with mock.patch.object(spool._writes, "put"):
+            self.assertRaises(RuntimeError, spool.append, [
+                {"channel": "orders", "name": "created", "data": "1"}])
+
+    def test_drop_events_of_error_responses(self):
+        self._init()
+
+        @self.app.route("/conflict")
+        def conflict():
+            self.pusher.outbox("orders", "created", {"id": 1})
+            abort(409)
+
+        @self.app.errorhandler(KeyError)
+        def key_error(e):
+            return "Database error", 500
+
+        @self.app.route("/db-error")
+        def db_error():
+            self.pusher.outbox("orders", "created", {"id": 2})
+            raise KeyError("db")
+
+        client = self.app.test_client()
+        self.assertEqual(409, client.get("/conflict").status_code)
+        self.assertEqual(500, client.get("/db-error").status_code)
+        self.client.spool.close()
+        self.assertEqual(0, self._pending())
+        self.assertEqual([], self._sent())
+
+    def test_send_without_response(self):
+        self._init()
+        with self.app.test_request_context():
+            self.pusher.outbox("orders", "created", {"id": 1})
+        self._wait_sent(1)
+        self.assertEqual(["orders"], [e["channel"] for e in self._sent()])
+
+    def test_invalid_event_raises(self):
+        self._init()
+        with self.app.test_request_context():
+            self.assertRaises(ValueError, self.pusher.outbox,
+                              "bad channel!", "ev", "x")
+            self.assertFalse(g.get("_pusher_outbox"))
+
+    def test_move_refused_events(self):
+        delivered = []
+
+        def send_request(request):
+            # pusher<2.1 does not validate batch channels
+            if any(e["channel"] in ("bad channel!", "refused")
+                   for e in request.params["batch"]):
+                raise PusherBadRequest("refused")
+            delivered.extend(request.params["batch"])
+            return {}
+        self.send_request.side_effect = send_request
+        self._init()
+        self.client.spool.close()
+        conn = sqlite3.connect(self.path)
+        with conn:
+            # spooled by an older version, without validation
+            conn.executemany(
+                "INSERT INTO pusher_outbox (key, event) VALUES (?, ?)",
+                [("KEY", json.dumps({"channel": c, "name": "ev",
+                                     "data": "x"}))
+                 for c in ("a", "bad channel!", "refused", "b")])
+        self.client.spool.start()
+        self._wait_sent(2)
+        self.assertEqual(["a", "b"], [e["channel"] for e in delivered])
+        failed = conn.execute(
+            "SELECT event FROM pusher_outbox_failed ORDER BY id").fetchall()
+        conn.close()
+        self.assertEqual(["bad channel!", "refused"],
+                         [json.loads(row[0])["channel"] for row in failed])
+
+    def test_replay_after_crash(self):
+        self._init()
+        self.client.spool.close()
+        self.send_request.side_effect = Exception("crash")
+        with self.app.app_context():
+            self.pusher.outbox("a", "ev", "x")
+        self.client.spool.close()
+        self.assertEqual(1, self._pending())
+
+        self.send_request.reset_mock(side_effect=True)
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config["PUSHER_OUTBOX"] = self.path
+        self._init()
+        self._wait_sent(1)
+        self.assertEqual([{"channel": "a", "name": "ev", "data": "x"}],
+                         self._sent())
+
+    def test_retry_failed_send(self):
+        self.send_request.side_effect = [Exception("down"), {}]
+        self._init()
+        self.app.test_client().get("/order/1")
+        self._wait_sent(2)
+        self.assertEqual(2, self.send_request.call_count)
+
+    def test_concurrent_requests(self):
+        self._init()
+        client = self.app.test_client()
+        threads = [threading.Thread(target=client.get, args=("/order/3",))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._wait_sent(30)
+        self.assertEqual(30, len(self._sent()))
+
+    def test_without_spool(self):
+        del self.app.config["PUSHER_OUTBOX"]
+        self._init()
+        self.app.test_client().get("/order/11")
+        self.assertEqual(2, self.send_request.call_count)
+        self.assertEqual(11, len(self._sent()))
+        self.app.test_client().get("/order/2?fail=1")
+        self.assertEqual(2, self.send_request.call_count)
+
+
+@unittest.skipIf(generate_shared_secret is None,
+                 "encrypted channels require pusher>=2.1")
+class PusherEncryptedChannelTest(unittest.TestCase):
+    master_key = b"0123456789abcdef0123456789abcdef"
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config.update({
+            "PUSHER_ENCRYPTION_MASTER_KEY": self.master_key.decode("ascii"),
+            "PUSHER_CHANNEL_KEYS_CACHE_SIZE": 2,
+        })
+        self.pusher = Pusher(self.app)
+        self.pusher.auth(lambda channel_name, socket_id: True)
+        with self.app.app_context():
+            self.client = self.pusher.client
+        patcher = mock.patch.object(self.client._pusher_client.http,
+                                    "send_request", return_value={})
+        self.send_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _decrypt(self, channel, data):
+        box = nacl.secret.SecretBox(
+            generate_shared_secret(channel.encode("utf-8"), self.master_key))
+        data = json.loads(data)
+        return json.loads(box.decrypt(
+            base64.b64decode(data["ciphertext"]),
+            base64.b64decode(data["nonce"])).decode("utf-8"))
+
+    def test_trigger(self):
+        self.client.trigger("private-encrypted-a", "ev", {"a": 1}, "1.2")
+        request = self.send_request.call_args[0][0]
+        self.assertEqual("/apps/1234/events", request.path)
+        self.assertEqual(["private-encrypted-a"], request.params["channels"])
+        self.assertEqual("1.2", request.params["socket_id"])
+        self.assertEqual({"a": 1}, self._decrypt("private-encrypted-a",
+                                                 request.params["data"]))
+
+    def test_trigger_multiple_encrypted_channels(self):
+        self.assertRaises(ValueError, self.client.trigger,
+                          ["private-encrypted-a", "private-encrypted-b"],
+                          "ev", {"a": 1})
+
+    def test_trigger_batch(self):
+        batch = [{"channel": "private-encrypted-a", "name": "ev",
+                  "data": {"a": 1}},
+                 {"channel": "b", "name": "ev", "data": {"b": 2}}]
+        self.client.trigger_batch(batch)
+        events = self.send_request.call_args[0][0].params["batch"]
+        self.assertEqual({"a": 1}, self._decrypt("private-encrypted-a",
+                                                 events[0]["data"]))
+        self.assertEqual({"b": 2}, json.loads(events[1]["data"]))
+        # the events of the caller are not changed
+        self.assertEqual({"a": 1}, batch[0]["data"])
+
+    def test_trigger_batch_validation(self):
+        self.assertRaises(ValueError, self.client.trigger_batch, [
+            {"channel": "private-encrypted-a", "name": "ev",
+             "data": "x" * 10241}])
+        self.assertFalse(self.send_request.called)
+
+    def test_auth(self):
+        response = self.app.test_client().post("/pusher/auth", data={
+            "channel_name": "private-encrypted-a", "socket_id": "1.2"})
+        self.assertEqual(200, response.status_code)
+        expected = self.client.authenticate("private-encrypted-a", "1.2")
+        data = json.loads(response.data)
+        self.assertEqual(expected["auth"], data["auth"])
+        self.assertEqual(expected["shared_secret"].decode("ascii"),
+                         data["shared_secret"])
+
+    def test_auth_without_cache(self):
+        app = Flask(__name__)
+        app.config.update(self.app.config)
+        app.config["PUSHER_CHANNEL_KEYS_CACHE_SIZE"] = 0
+        pusher = Pusher(app)
+        pusher.auth(lambda channel_name, socket_id: True)
+        with app.app_context():
+            self.assertIsNone(pusher.client.channel_keys)
+        response = app.test_client().post("/pusher/auth", data={
+            "channel_name": "private-encrypted-a", "socket_id": "1.2"})
+        self.assertEqual(200, response.status_code)
+        self.assertIn("shared_secret", json.loads(response.data))
+
+    def test_lru(self):
+        keys = self.client.channel_keys
+        with mock.patch.object(keys, "_derive",
+                               wraps=keys._derive) as derive:
+            for channel in ["private-encrypted-a", "private-encrypted-b",
+                            "private-encrypted-a", "private-encrypted-c",
+                            "private-encrypted-a", "private-encrypted-b"]:
+                keys.secret(channel, self.master_key)
+        self.assertEqual(["private-encrypted-a", "private-encrypted-b",
+                          "private-encrypted-c", "private-encrypted-b"],
+                         [c[0][0] for c in derive.call_args_list])
+
+    def test_master_key_rotation(self):
+        self.client.trigger("private-encrypted-a", "ev", {"a": 1})
+        self.master_key = b"fedcba9876543210fedcba9876543210"
+        self.client._pusher_client._encryption_master_key = self.master_key
+        self.client.trigger("private-encrypted-a", "ev", {"a": 2})
+        request = self.send_request.call_args[0][0]
+        self.assertEqual({"a": 2}, self._decrypt("private-encrypted-a",
+                                                 request.params["data"]))
+
+
+class BenchmarksTest(unittest.TestCase):
+
+    def test_run(self):
+        results = list(benchmarks.run(iterations=2))
+        names = [r["name"] for r in results]
+        self.assertIn("auth_buffered_100", names)
+        self.assertIn("webhook_100k", names)
+        self.assertIn("trigger_batch_10", names)
+        if generate_shared_secret is not None:
+            self.assertIn("encrypt_event_uncached", names)
+        self.assertIn("outbox_request_10", names)
+        self.assertIn("startup_init_app_lazy", names)
+        for result in results:
+            self.assertTrue(result["p50_ms"] <= result["p99_ms"])
+
+    def test_filter(self):
+        results = list(benchmarks.run(iterations=1, names=["webhook"]))
+        self.assertEqual(["webhook_1k", "webhook_10k", "webhook_100k"],
+                         [r["name"] for r in results])
+
+
+def load_tests(loader, tests, pattern):
+    # `setup.py test` only loads this module, pytest collects tests_async.py
+    if sys.version_info >= (3, 5):
+        import tests_async
+        tests.addTests(loader.loadTestsFromModule(tests_async))
+    return tests
+
+
 if __name__ == '__main__':
     unittest.main()
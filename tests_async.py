@@ -0,0 +1,249 @@
+import asyncio
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:  # pragma: no cover
+    import mock
+
+from flask import Flask, json
+
+try:
+    import aiohttp
+    from aiohttp import web
+    from flask_pusher_async import AsyncPusher
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+import benchmarks
+
+pusher_conf = {
+    "PUSHER_APP_ID": "1234",
+    "PUSHER_KEY": "KEY",
+    "PUSHER_SECRET": "SUPERSECRET",
+}
+
+SOCKET_ID = "1.42"
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp not installed")
+class AsyncPusherClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config.update(PUSHER_SSL=False, PUSHER_HOST="127.0.0.1")
+        self.received = []
+
+    async def _serve(self, coro_factory):
+        async def events(request):
+            self.received.append((request.path, await request.json()))
+            return web.json_response({})
+
+        web_app = web.Application()
+        web_app.router.add_post("/apps/1234/events", events)
+        web_app.router.add_post("/apps/1234/batch_events", events)
+        runner = web.AppRunner(web_app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.app.config["PUSHER_PORT"] = port
+        pusher = AsyncPusher(self.app)
+        try:
+            with self.app.app_context():
+                try:
+                    return await coro_factory(pusher.client)
+                finally:
+                    pusher.client.close()
+        finally:
+            await runner.cleanup()
+
+    def test_trigger(self):
+        result = asyncio.run(self._serve(
+            lambda client: client.trigger("a", "ev", {"x": 1})))
+        self.assertEqual({}, result)
+        path, body = self.received[0]
+        self.assertEqual("/apps/1234/events", path)
+        self.assertEqual(["a"], body["channels"])
+        self.assertEqual({"x": 1}, json.loads(body["data"]))
+
+    def test_concurrent_triggers_share_session(self):
+        async def fan_out(client):
+            await asyncio.gather(*[
+                client.trigger("c%d" % i, "ev", "x") for i in range(5)
+            ])
+
+        with mock.patch.object(aiohttp, "ClientSession",
+                               wraps=aiohttp.ClientSession) as session:
+            asyncio.run(self._serve(fan_out))
+        self.assertEqual(1, session.call_count)
+        self.assertEqual(5, len(self.received))
+
+    def test_trigger_batch_awaits_every_request(self):
+        batch = [{"channel": "c%d" % i, "name": "ev", "data": "x"}
+                 for i in range(15)]
+        result = asyncio.run(self._serve(
+            lambda client: client.trigger_batch(batch)))
+        self.assertEqual({}, result)
+        self.assertEqual([10, 5],
+                         [len(body["batch"]) for _, body in self.received])
+
+    def test_broadcast(self):
+        channels = ["c%d" % i for i in range(150)] + ["bad channel"]
+        result = asyncio.run(self._serve(
+            lambda client: client.broadcast(channels, "ev", {"x": 1})))
+        self.assertEqual([channels[:100]], result.succeeded)
+        [(chunk, error)] = result.failed
+        self.assertEqual(channels[100:], chunk)
+        self.assertIsInstance(error, ValueError)
+        self.assertEqual([channels[:100]],
+                         [body["channels"] for _, body in self.received])
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp not installed")
+class AsyncPusherViewTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = benchmarks.FakePusherAPI().start()
+        self.addCleanup(self.api.stop)
+        self.app = Flask(__name__)
+        self.app.config.update(pusher_conf)
+        self.app.config.update(self.api.config)
+        self.pusher = AsyncPusher(self.app)
+        self.addCleanup(self._close)
+
+        @self.app.route("/notify/<channel>")
+        async def notify(channel):
+            await self.pusher.client.trigger(channel, "ev", {"x": 1})
+            info = await self.pusher.client.channels_info()
+            return json.dumps(info)
+
+    def _close(self):
+        with self.app.app_context():
+            self.pusher.client.close()
+
+    def test_views_share_session(self):
+        client = self.app.test_client()
+        with mock.patch.object(aiohttp, "ClientSession",
+                               wraps=aiohttp.ClientSession) as session:
+            for i in range(3):
+                response = client.get("/notify/c%d" % i)
+                self.assertEqual(200, response.status_code)
+                self.assertEqual({}, json.loads(response.data))
+        self.assertEqual(1, session.call_count)
+        posts = [body for method, _, body in self.api.requests
+                 if method == "POST"]
+        self.assertEqual(["c0", "c1", "c2"],
+                         [json.loads(body)["channels"][0] for body in posts])
+
+    def test_close_session(self):
+        self.app.test_client().get("/notify/a")
+        with self.app.app_context():
+            backend = self.pusher.client._pusher_client.http
+        session = backend._session
+        self._close()
+        self.assertTrue(session.closed)
+        self.assertIsNone(backend._session)
+        # a new session is made on next use
+        self.assertEqual(200, self.app.test_client().get("/notify/a")
+                         .status_code)
+
+    def test_metrics(self):
+        recorder = mock.Mock()
+        app = Flask(__name__)
+        app.config.update(pusher_conf)
+        app.config.update(self.api.config, PUSHER_METRICS=[recorder])
+        pusher = AsyncPusher(app)
+        self.api.status = 500
+        self.api.latency = 0.05
+
+        async def trigger():
+            with app.app_context():
+                try:
+                    await pusher.client.trigger("a", "ev", "x")
+                finally:
+                    pusher.client.close()
+
+        with self.assertRaises(Exception):
+            asyncio.run(trigger())
+        (metric, duration, outcome), labels = recorder.record.call_args
+        self.assertEqual("trigger", metric)
+        self.assertEqual("PusherBadStatus", outcome)
+        self.assertGreaterEqual(duration, 0.05)
+        self.assertEqual({"method": "trigger", "channels": 1}, labels)
+
+    def test_reconcile(self):
+        app = Flask(__name__)
+        app.config.update(pusher_conf)
+        app.config.update(self.api.config, PUSHER_PRESENCE_STORE=True)
+        pusher = AsyncPusher(app)
+        pusher.presence.storage.occupy("private-old")
+
+        async def reconcile():
+            with app.app_context():
+                try:
+                    await pusher.presence.reconcile()
+                finally:
+                    pusher.client.close()
+
+        asyncio.run(reconcile())
+        self.assertTrue(pusher.presence.synced)
+        self.assertFalse(pusher.presence.storage.is_occupied("private-old"))
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp not installed")
+class AsyncPusherConfigTest(unittest.TestCase):
+
+    def test_refuse_sync_only_features(self):
+        configs = [{key: 1} for key in AsyncPusher.SYNC_ONLY]
+        configs.append({"PUSHER_OVERSIZE": "split"})
+        for config in configs:
+            app = Flask(__name__)
+            app.config.update(pusher_conf)
+            app.config.update(config)
+            with self.assertRaises(ValueError):
+                AsyncPusher(app)
+
+    def test_refuse_outbox(self):
+        app = Flask(__name__)
+        app.config.update(pusher_conf)
+        pusher = AsyncPusher(app)
+        with self.assertRaises(ValueError):
+            pusher.outbox("a", "ev", "x")
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp not installed")
+class AsyncPusherAuthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.debug = True
+        self.app.config.update(pusher_conf)
+        self.pusher = AsyncPusher(self.app)
+        self.client = self.app.test_client()
+
+    def test_async_auth_handler(self):
+        @self.pusher.auth
+        async def auth(channel_name, socket_id):
+            await asyncio.sleep(0)
+            return "b" not in channel_name
+
+        @self.pusher.channel_data
+        async def channel_data(channel_name, socket_id):
+            return {"foo": "bar"}
+
+        response = self.client.post("/pusher/auth",
+                                    data={"channel_name[0]": "presence-a",
+                                          "channel_name[1]": "private-b",
+                                          "socket_id": SOCKET_ID})
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.data)
+        self.assertEqual(200, data["presence-a"]["status"])
+        channel_data = json.loads(data["presence-a"]["data"]["channel_data"])
+        self.assertEqual("bar", channel_data["foo"])
+        self.assertEqual(403, data["private-b"]["status"])
+
+
+if __name__ == '__main__':
+    unittest.main()